@@ -0,0 +1,341 @@
+"""Finds SQL anti-patterns in BigQuery query text.
+
+Queries are tokenized in one pass (comments dropped, string literals and
+backtick identifiers kept as single tokens, paren depth recorded), then
+every rule looks at the token list. A rule is a function
+rule(tokens, context) returning a list of findings, pass your own rules
+dict to analyze / analyze_batch to add or drop rules.
+
+Built in rules:
+select_star            SELECT * or SELECT t.* (not COUNT(*))
+cross_join             CROSS JOIN or comma join between tables
+order_by_without_limit top level ORDER BY without LIMIT
+no_filter              top level query reading tables without WHERE
+missing_partition_filter
+                       partitioned table read without a filter on its
+                       partition column, needs context['partition_columns']
+                       mapping table name to partition column
+
+Run with --benchmark to compare throughput with the substring checks
+bq_query_monitor used before.
+"""
+import argparse
+import collections
+import re
+import time
+
+Token = collections.namedtuple('Token', 'kind value depth offset')
+
+_TOKEN = re.compile(r"""
+    (?P<space>\s+)
+    |(?P<comment>--[^\n]*|\#[^\n]*|/\*.*?\*/)
+    |(?P<string>[rRbB]{0,2}(?:'''.*?'''|\"\"\".*?\"\"\"
+                          |'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"))
+    |(?P<ident>`[^`]*`)
+    |(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+)
+    |(?P<word>[A-Za-z_][A-Za-z_0-9]*)
+    |(?P<op><>|!=|<=|>=|\|\||<<|>>|.)
+    """, re.S | re.X)
+
+# Keywords that end a FROM clause
+_CLAUSE_END = {'WHERE', 'GROUP', 'HAVING', 'QUALIFY', 'WINDOW', 'ORDER',
+               'LIMIT', 'UNION', 'INTERSECT', 'EXCEPT', 'SELECT', ';'}
+_PARTITION_PSEUDO_COLUMNS = {'_PARTITIONTIME', '_PARTITIONDATE'}
+
+
+def tokenize(query):
+    # Significant tokens of query, words are uppercased
+    tokens = []
+    depth = 0
+    for match in _TOKEN.finditer(query):
+        kind = match.lastgroup
+        if kind in ('space', 'comment'):
+            continue
+        value = match.group()
+        if kind == 'word':
+            value = value.upper()
+        elif value == ')':
+            depth -= 1
+        tokens.append(Token(kind, value, depth, match.start()))
+        if value == '(' and kind == 'op':
+            depth += 1
+    return tokens
+
+
+def _finding(rule, token, message):
+    return {"rule": rule, "offset": token.offset, "message": message}
+
+
+def _table_name(token):
+    return token.value.strip('`').lower()
+
+
+def _function_froms(tokens):
+    # Positions of FROM keywords inside function call parens, e.g.
+    # EXTRACT(YEAR FROM ts), SUBSTRING(s FROM 2) or TRIM(BOTH 'x' FROM s).
+    # A paren right after a name is a call unless it holds a subquery
+    # (SELECT / WITH) or follows FROM / JOIN (parenthesized joins).
+    positions = set()
+    calls = []
+    for i, tok in enumerate(tokens):
+        if tok.kind == 'op' and tok.value == '(':
+            prev = tokens[i - 1] if i else None
+            nxt = tokens[i + 1] if i + 1 < len(tokens) else None
+            calls.append(prev is not None
+                         and prev.kind in ('word', 'ident')
+                         and prev.value not in ('FROM', 'JOIN')
+                         and (nxt is None
+                              or nxt.value not in ('SELECT', 'WITH')))
+        elif tok.kind == 'op' and tok.value == ')':
+            if calls:
+                calls.pop()
+        elif (tok.kind == 'word' and tok.value == 'FROM'
+              and calls and calls[-1]):
+            positions.add(i)
+    return positions
+
+
+def referenced_tables(tokens):
+    # Table names following FROM / JOIN, e.g. `project.dataset.table`
+    # or dataset.table, subqueries, UNNEST and the FROM of functions
+    # like EXTRACT are skipped
+    tables = []
+    skip = _function_froms(tokens)
+    for i, tok in enumerate(tokens[:-1]):
+        if i in skip:
+            continue
+        if tok.kind == 'word' and tok.value in ('FROM', 'JOIN'):
+            parts = []
+            j = i + 1
+            while j < len(tokens) and tokens[j].kind in ('word', 'ident'):
+                parts.append(_table_name(tokens[j]))
+                if (j + 1 < len(tokens)
+                        and tokens[j + 1].value in ('.', '-')):
+                    # unquoted project ids may contain -
+                    parts.append(tokens[j + 1].value)
+                    j += 2
+                else:
+                    break
+            if parts and parts[0] != 'unnest':
+                tables.append(''.join(parts))
+    return tables
+
+
+def select_star(tokens, context):
+    findings = []
+    for i, tok in enumerate(tokens[1:], 1):
+        if tok.value != '*' or tok.kind != 'op':
+            continue
+        prev = tokens[i - 1].value
+        if prev in ('SELECT', 'DISTINCT', 'ALL', ','):
+            findings.append(_finding('select_star', tok,
+                                     'SELECT * reads every column'))
+        elif prev == '.' and i > 1 and tokens[i - 2].kind in ('word',
+                                                              'ident'):
+            findings.append(_finding('select_star', tok,
+                                     'SELECT t.* reads every column of t'))
+    return findings
+
+
+def cross_join(tokens, context):
+    findings = []
+    # Open FROM clauses per paren depth, with the table names and aliases
+    # seen so far in each (last part of a path, as BigQuery aliases it)
+    from_names = {}
+    skip = _function_froms(tokens)
+    for i, tok in enumerate(tokens):
+        nxt = tokens[i + 1] if i + 1 < len(tokens) else None
+        if tok.value == 'FROM' and tok.kind == 'word' and i not in skip:
+            from_names[tok.depth] = set()
+        elif tok.value == ')':
+            from_names.pop(tok.depth + 1, None)
+        elif tok.value in _CLAUSE_END:
+            from_names.pop(tok.depth, None)
+        elif (tok.depth in from_names and tok.kind in ('word', 'ident')
+              and (nxt is None or nxt.value != '.')):
+            from_names[tok.depth].add(_table_name(tok))
+        if nxt is None:
+            continue
+        if tok.value == 'CROSS' and nxt.value == 'JOIN':
+            after = tokens[i + 2] if i + 2 < len(tokens) else None
+            if after is None or after.value != 'UNNEST':
+                findings.append(_finding('cross_join', tok,
+                                         'CROSS JOIN of two tables'))
+        elif (tok.value == ',' and tok.depth in from_names
+              and nxt.value != 'UNNEST'
+              and _table_name(nxt) not in from_names[tok.depth]):
+            # FROM t, t.array_column is a correlated join, not a cross join
+            findings.append(_finding('cross_join', tok,
+                                     'comma join is a CROSS JOIN'))
+    return findings
+
+
+def order_by_without_limit(tokens, context):
+    order_by = None
+    for i, tok in enumerate(tokens[:-1]):
+        if tok.depth != 0 or tok.kind != 'word':
+            continue
+        if tok.value == 'ORDER' and tokens[i + 1].value == 'BY':
+            order_by = tok
+        elif tok.value == 'LIMIT':
+            order_by = None
+    if order_by is None:
+        return []
+    return [_finding('order_by_without_limit', order_by,
+                     'ORDER BY without LIMIT sorts the whole result '
+                     'on one worker')]
+
+
+def no_filter(tokens, context):
+    top = [tok.value for tok in tokens
+           if tok.depth == 0 and tok.kind == 'word']
+    if 'FROM' not in top or 'WHERE' in top:
+        return []
+    first_from = [tok for tok in tokens
+                  if tok.depth == 0 and tok.value == 'FROM'][0]
+    return [_finding('no_filter', first_from,
+                     'query reads tables without a WHERE filter')]
+
+
+def missing_partition_filter(tokens, context):
+    partition_columns = (context or {}).get('partition_columns')
+    if not partition_columns:
+        return []
+    filtered = set()
+    in_where = False
+    for tok in tokens:
+        if tok.kind != 'word' and tok.kind != 'ident':
+            continue
+        if tok.value in ('WHERE', 'ON', 'QUALIFY', 'HAVING'):
+            in_where = True
+        elif tok.value in _CLAUSE_END:
+            in_where = False
+        elif in_where:
+            filtered.add(_table_name(tok).upper())
+    findings = []
+    for table in referenced_tables(tokens):
+        column = None
+        for name, col in partition_columns.items():
+            if table == name.lower() or table.endswith('.' + name.lower()):
+                column = col
+                break
+        if column is None:
+            continue
+        if (column.upper() not in filtered
+                and not filtered & _PARTITION_PSEUDO_COLUMNS):
+            findings.append({"rule": 'missing_partition_filter',
+                             "offset": None,
+                             "message": '{} read without a filter on '
+                                        'partition column {}'.format(
+                                            table, column)})
+    return findings
+
+
+RULES = collections.OrderedDict([
+    ('select_star', select_star),
+    ('cross_join', cross_join),
+    ('order_by_without_limit', order_by_without_limit),
+    ('no_filter', no_filter),
+    ('missing_partition_filter', missing_partition_filter),
+])
+
+
+def analyze(query, rules=None, context=None):
+    # List of findings (dicts with rule, offset and message) for query
+    if rules is None:
+        rules = RULES
+    tokens = tokenize(query)
+    findings = []
+    for rule in rules.values():
+        findings.extend(rule(tokens, context))
+    return findings
+
+
+def analyze_batch(queries, rules=None, context=None):
+    # queries maps a key (e.g. job id) to query text, returns key ->
+    # findings. Identical texts, common for scheduled queries, are
+    # analyzed once.
+    by_text = {}
+    results = {}
+    for key, query in queries.items():
+        if query not in by_text:
+            by_text[query] = analyze(query, rules, context)
+        results[key] = by_text[query]
+    return results
+
+
+def rule_names(findings):
+    return sorted({finding["rule"] for finding in findings})
+
+
+def _substring_checks(query, referenced_tables):
+    # What bq_query_monitor did before this module
+    return ('SELECT *' in query.upper(),
+            str(referenced_tables).count("TableReference"))
+
+
+def _benchmark_queries(count):
+    shapes = [
+        "SELECT * FROM `proj.ds.events_{i}` WHERE event_date = '2020-01-01'",
+        "select  t.* from ds.orders t, ds.customers c order by t.id",
+        "SELECT name, COUNT(*) AS n FROM ds.users_{i} GROUP BY name",
+        "-- SELECT * FROM old\nSELECT a, b FROM ds.t_{i} WHERE a = 'SELECT *'",
+        "WITH x AS (SELECT id, ROW_NUMBER() OVER (ORDER BY ts) rn "
+        "FROM ds.log_{i}) SELECT * FROM x CROSS JOIN ds.dim LIMIT 10",
+    ]
+    return {i: shapes[i % len(shapes)].format(i=i) for i in range(count)}
+
+
+def benchmark(count=10000):
+    queries = _benchmark_queries(count)
+    refs = ['TableReference(DatasetReference(p, d), t)'] * 2
+
+    start = time.time()
+    old_star = sum(_substring_checks(q, refs)[0] for q in queries.values())
+    old_seconds = time.time() - start
+
+    start = time.time()
+    for query in queries.values():
+        analyze(query)
+    new_seconds = time.time() - start
+
+    start = time.time()
+    batch = analyze_batch(queries)
+    batch_seconds = time.time() - start
+    new_star = sum('select_star' in rule_names(f) for f in batch.values())
+
+    for name, seconds in (('substring checks', old_seconds),
+                          ('analyze', new_seconds),
+                          ('analyze_batch', batch_seconds)):
+        print("{:<17} {:>9.0f} queries/s".format(
+            name, count / max(seconds, 1e-9)))
+    print("select star flagged: substring {} analyzer {}".format(
+        old_star, new_star))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--benchmark',
+        action='store_true',
+        help=('Compare throughput with the old substring checks')
+        )
+    parser.add_argument(
+        '--count',
+        required=False,
+        default=10000,
+        help=('Number of queries for --benchmark, 10000 is default')
+        )
+    parser.add_argument(
+        '--query',
+        required=False,
+        help=('Query text to analyze')
+        )
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(int(args.count))
+    elif args.query:
+        for finding in analyze(args.query):
+            print(finding)
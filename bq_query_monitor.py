@@ -1,83 +1,377 @@
 """This function reads bigquery job metadata
 It takes input as projectId and gets metadata for default last 24 Hours
-Produces two output files
-bq_monitor_YYYY-MM-DD.json which has details about query performance
-bq_monitor_query_text_YYYY-MM-DD.json which has entire SQL Query Text for
-corresponding jobids.
+Produces three output files
+bq_monitor_YYYY-MM-DD.json which has details about query performance,
+one JSON record per job written as soon as the job is read
+(--output_format gzip gives .json.gz, parquet gives .parquet)
+bq_monitor_query_text_YYYY-MM-DD.json which has the SQL Query Text of
+each distinct query shape once, keyed by its fingerprint. Queries are
+normalized (literals replaced by ?, comments and whitespace dropped) and
+hashed, each job carries the query_fingerprint of its query.
+Query text is checked for anti-patterns (SELECT *, cross joins, ORDER BY
+without LIMIT ...) with bq_query_analyzer, once per fingerprint. Findings
+are kept with the query text and their rule names in query_findings.
+bq_monitor_fingerprints_YYYY-MM-DD.json which has per fingerprint job
+count, total bytes billed and p50 / p95 execution time, most costly first,
+of the jobs written by the run (a reservoir sample of up to 1000 execution
+times per fingerprint gives the percentiles).
 Output files contain important paramters such as execution time,
 tables scanned, bytes total_bytes_billed etc.
 These parameters could be analyzed to improve query performance and
 reduce costs.
+Statistics returned by list_jobs are used as is, get_job is only called
+for jobs whose listing is incomplete and those calls run on a thread pool
+(--workers) with retry and backoff on rate limit errors.
+Time spent listing, waiting for get_job and writing files is printed.
+With --incremental only jobs finished since the previous run are
+fetched and appended to the day's files, a watermark (newest creation time
+and ids already written) is kept in --watermark_file between runs.
 This can be further enhanced to put results into database
 Author: Chetan Dixit
 """
-from google.cloud import bigquery
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED, ALL_COMPLETED
 import datetime
 import argparse
-import json
+import hashlib
+import random
+import re
+import time
+from gcp_retry import call_with_retry
+import gcp_clients
+import gcp_instrumentation
+from record_writers import RecordWriter, iter_records, EXTENSIONS
+from record_writers import read_json, write_json
+import bq_query_analyzer
 
 
-def get_data(projectid, hours=24, max_results=500):
+def needs_fetch(job):
+    # list_jobs already returns the statistics of finished jobs, only go
+    # back to get_job when the listing left out something we report on
+    return job.query is None or job.started is None or job.ended is None
+
+
+def fetch_job(client, job, retries=5):
+    # get_job needs the location for jobs outside US / EU multi-regions
+    return call_with_retry(client.get_job, job.job_id,
+                           project=job.project, location=job.location,
+                           retries=retries, endpoint='bigquery.jobs.get')
+
+
+def _drain(pending, timings, return_when):
+    # Wait for fetches to finish, time spent blocked here is fetch time
+    start = time.time()
+    done, pending = wait(pending, return_when=return_when)
+    timings['fetch_seconds'] += time.time() - start
+    finished = []
+    for future in done:
+        try:
+            finished.append(future.result())
+        except Exception as exc:
+            print('Unable to get job statistics: {}'.format(exc))
+    return finished, pending
+
+
+def iter_query_jobs(client, min_creation_time, max_results=None,
+                    workers=8, retries=5, timings=None,
+                    state_filter=None, skip_job=None):
+    # Yields finished query jobs with complete statistics.
+    # Jobs whose listing is complete are yielded straight away, the rest
+    # are fetched with get_job on a bounded thread pool.
+    # Jobs for which skip_job(job) is true are dropped before any fetch.
+    # timings (a dict) is filled with the seconds spent listing, the
+    # seconds spent waiting for get_job and the number of get_job calls.
+    if timings is None:
+        timings = {}
+    timings.update(list_seconds=0.0, fetch_seconds=0.0, fetch_calls=0)
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Use all_users to include jobs run by all users in the project.
+        jobs = gcp_instrumentation.iter_pages(
+            'bigquery.jobs.list',
+            client.list_jobs(min_creation_time=min_creation_time,
+                             max_results=max_results,
+                             state_filter=state_filter, all_users=True))
+        while True:
+            start = time.time()
+            job = next(jobs, None)
+            timings['list_seconds'] += time.time() - start
+            if job is None:
+                break
+            # Running jobs have no execution time yet
+            if job.job_type != 'query' or job.state != 'DONE':
+                continue
+            if skip_job is not None and skip_job(job):
+                continue
+            if not needs_fetch(job):
+                yield job
+                continue
+            timings['fetch_calls'] += 1
+            pending.add(pool.submit(fetch_job, client, job, retries))
+            # Keep a bounded number of fetches in flight
+            if len(pending) >= workers * 4:
+                finished, pending = _drain(pending, timings,
+                                           FIRST_COMPLETED)
+                for j in finished:
+                    yield j
+        finished, pending = _drain(pending, timings, ALL_COMPLETED)
+        for j in finished:
+            yield j
+
+
+# Parts of SQL text that do not change the shape of a query
+_SQL_TOKENS = re.compile(r"""
+    (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+    |(?P<comment>--[^\n]*|\#[^\n]*|/\*.*?\*/)
+    |(?P<ident>`[^`]*`)
+    |(?P<number>\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b)
+    |(?P<space>\s+)
+    """, re.S | re.X)
+_SQL_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+
+def _normalize_token(match):
+    kind = match.lastgroup
+    if kind in ('string', 'number'):
+        return '?'
+    if kind in ('comment', 'space'):
+        return ' '
+    return match.group()
+
+
+def normalize_query(query):
+    # Query shape: literals become ?, IN lists of literals become (?+),
+    # comments dropped, whitespace collapsed and text lowercased.
+    # Identifiers in backticks are kept as written.
+    normalized = _SQL_TOKENS.sub(_normalize_token, query)
+    normalized = _SQL_LIST.sub('(?+)', normalized)
+    parts = re.split(r"(`[^`]*`)", normalized.strip())
+    return ''.join(part if part.startswith('`') else
+                   re.sub(r" +", ' ', part).lower() for part in parts)
+
+
+def fingerprint_query(normalized):
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+class FingerprintRollups(object):
+    # Per query shape: job count, bytes billed, p50 / p95 execution time
+    # of the records added. Execution times are kept in a reservoir sample
+    # of reservoir_size per fingerprint, exact up to that many jobs, so
+    # memory does not grow with the number of jobs.
+    def __init__(self, reservoir_size=1000, seed=None):
+        self.reservoir_size = reservoir_size
+        self.rollups = {}
+        self._random = random.Random(seed)
+
+    def add(self, record):
+        rollup = self.rollups.setdefault(record["query_fingerprint"], {
+            "query_fingerprint": record["query_fingerprint"],
+            "job_count": 0,
+            "total_bytes_billed": 0,
+            "execution_seconds": []})
+        rollup["job_count"] += 1
+        rollup["total_bytes_billed"] += record["total_bytes_billed"] or 0
+        sample = rollup["execution_seconds"]
+        if len(sample) < self.reservoir_size:
+            sample.append(record["execution_seconds"])
+        else:
+            # Algorithm R, every job stays in the sample with equal odds
+            i = self._random.randrange(rollup["job_count"])
+            if i < self.reservoir_size:
+                sample[i] = record["execution_seconds"]
+
+    def rows(self):
+        # Rollups most costly first
+        rows = []
+        for rollup in self.rollups.values():
+            row = dict(rollup)
+            seconds = sorted(row.pop("execution_seconds"))
+            row["p50_execution_seconds"] = gcp_instrumentation.percentile(seconds, 50)
+            row["p95_execution_seconds"] = gcp_instrumentation.percentile(seconds, 95)
+            rows.append(row)
+        return sorted(rows, key=lambda r: r["total_bytes_billed"],
+                      reverse=True)
+
+
+def job_record(j, fingerprint=None, findings=()):
+    # Get required attribute from JobStatistics Object and make a dict
+    # findings are the bq_query_analyzer rule names hit by the query
+    return {
+        "job_id": j.job_id,
+        "created": j.created.isoformat(),
+        "num_of_tables_referred": len(j.referenced_tables),
+        "select_star_used": 'select_star' in findings,
+        "query_findings": list(findings),
+        "start_time": str(j.started),
+        "total_bytes_billed": j.total_bytes_billed,
+        "cache_hit": j.cache_hit,
+        "total_bytes_processed": j.total_bytes_processed,
+        "execution_time": str(j.ended-j.started),
+        "execution_seconds": (j.ended-j.started).total_seconds(),
+        "query_fingerprint": fingerprint,
+        "user_email": j.user_email}
+
+
+def job_record_schema():
+    # pyarrow schema of job_record for parquet output, so columns that are
+    # empty or None in the first row group (query_findings, user_email,
+    # bytes of cached jobs) keep their type
+    import pyarrow
+
+    return pyarrow.schema([
+        ("job_id", pyarrow.string()),
+        ("created", pyarrow.string()),
+        ("num_of_tables_referred", pyarrow.int64()),
+        ("select_star_used", pyarrow.bool_()),
+        ("query_findings", pyarrow.list_(pyarrow.string())),
+        ("start_time", pyarrow.string()),
+        ("total_bytes_billed", pyarrow.int64()),
+        ("cache_hit", pyarrow.bool_()),
+        ("total_bytes_processed", pyarrow.int64()),
+        ("execution_time", pyarrow.string()),
+        ("execution_seconds", pyarrow.float64()),
+        ("query_fingerprint", pyarrow.string()),
+        ("user_email", pyarrow.string())])
+
+
+def write_results(jobs, output_format='ndjson', mode='w', timings=None,
+                  on_record=None):
+    # Writes a record per job as it is produced, mode 'a' appends to
+    # today's files. Only the fingerprints seen are held in memory.
+    # on_record(record) is called once a record is written.
+    if timings is None:
+        timings = {}
+    timings['write_seconds'] = 0.0
+    # Findings (rule names) per fingerprint written so far
+    findings = {}
+    query_text_file = ("bq_monitor_query_text_" + str(datetime.date.today())
+                       + ".json")
+    if mode == 'a':
+        for r in iter_records(query_text_file):
+            findings[r["query_fingerprint"]] = bq_query_analyzer.rule_names(
+                r["findings"])
+    schema = None
+    if output_format == 'parquet':
+        schema = job_record_schema()
+    records = RecordWriter("bq_monitor_", output_format, mode,
+                           schema=schema)
+    # Write each distinct query shape once, keyed by fingerprint
+    query_text = RecordWriter("bq_monitor_query_text_", 'ndjson', mode)
+    rollups = FingerprintRollups()
+    with records, query_text:
+        for j in jobs:
+            start = time.time()
+            normalized = normalize_query(j.query)
+            fingerprint = fingerprint_query(normalized)
+            # Queries of the same shape have the same anti-patterns so
+            # they are analyzed once
+            if fingerprint not in findings:
+                analysis = bq_query_analyzer.analyze(j.query)
+                query_text.write({
+                    "query_fingerprint": fingerprint,
+                    "query_text": normalized,
+                    "example_job_id": j.job_id,
+                    "findings": analysis})
+                findings[fingerprint] = bq_query_analyzer.rule_names(
+                    analysis)
+            record = job_record(j, fingerprint, findings[fingerprint])
+            records.write(record)
+            rollups.add(record)
+            timings['write_seconds'] += time.time() - start
+            if on_record is not None:
+                on_record(record)
+    # Rollups cover the jobs written by this run
+    start = time.time()
+    with RecordWriter("bq_monitor_fingerprints_", 'ndjson') as f:
+        for rollup in rollups.rows():
+            f.write(rollup)
+    timings['write_seconds'] += time.time() - start
+    return records.count
+
+
+def print_timings(count, timings):
+    print("Jobs: {} get_job calls: {} list: {:.2f}s fetch wait: {:.2f}s "
+          "write: {:.2f}s".format(count, timings['fetch_calls'],
+                                  timings['list_seconds'],
+                                  timings['fetch_seconds'],
+                                  timings['write_seconds']))
+
+
+def get_data(projectid, hours=24, max_results=500, workers=8, retries=5,
+             client=None, output_format='ndjson'):
     # Default parameters Last 24 Hours, return max 500 query stats
     # project = projectid #   # replace with your project ID
-    client = bigquery.Client(project=projectid)
+    if client is None:
+        client = gcp_clients.bigquery_client(projectid)
     mins_ago = (datetime.datetime.utcnow()
                 - datetime.timedelta(minutes=hours*60))
-    results = {}
-    query_text = {}
-    # Use all_users to include jobs run by all users in the project.
-    for job in client.list_jobs(
-                            min_creation_time=mins_ago,
-                            max_results=max_results,
-                            all_users=True):
-        # get JobStatistics from job
-        j = client.get_job(job.job_id)
-        if j.job_type == 'query':
-            # Look out for Select * in query text
-            if 'SELECT *' in j.query.upper():
-                all_columns_used = True
-            else:
-                all_columns_used = False
-            # Get required attribute from JobStatistics Object and make a dict,
-            # Count the TableReference from attribute query
-            results[job.job_id] = {
-                "job_id": job.job_id,
-                "num_of_tables_referred":
-                str(j.referenced_tables).count("TableReference"),
-                "select_star_used": all_columns_used,
-                "start_time": str(j.started),
-                "total_bytes_billed": j.total_bytes_billed,
-                "cache_hit": j.cache_hit,
-                "total_bytes_processed": j.total_bytes_processed,
-                "execution_time": str(j.ended-j.started),
-                "user_email": j.user_email}
-            # Make a separate dict with query text
-            # to analyze problematic queries
-            query_text[job.job_id] = {
-                "job_id": job.job_id,
-                "query_text": j.query}
-
-    # print (results)
-    # print (query_text)
-    # Write results to file
-    filename1 = "bq_monitor_"+str(datetime.date.today())+".json"
-    f1 = open(filename1, 'w')
-    for jobid in results:
-        f1.write(str(results[jobid])+"\n")
-    f1.close()
-    filenametemp = "temp_"+filename1
-    temp_json = json.dumps(results)
-    ft = open(filenametemp, 'w')
-    ft.write(temp_json)
-    # Write Query text alongwith jobid to file
-    filename2 = "bq_monitor_query_text_"+str(datetime.date.today())+".json"
-    f2 = open(filename2, 'w')
-    for jobid in query_text:
-        f2.write(str(query_text[jobid])+"\n")
-    f2.close()
+    timings = {}
+    count = write_results(iter_query_jobs(client, mins_ago, max_results,
+                                          workers, retries, timings),
+                          output_format, 'w', timings)
+    timings['jobs'] = count
+    print_timings(count, timings)
+    return timings
 # End get_data
 
 
+def get_incremental_data(projectid, watermark_file, hours=24,
+                         lookback_hours=6, workers=8, retries=5,
+                         client=None, output_format='ndjson'):
+    # Fetches only jobs finished since the previous run and appends them
+    # to today's files. First run (no watermark) covers the last hours.
+    # Later runs list from lookback_hours before the watermark, queries
+    # run at most 6 hours so jobs still running last time are picked up
+    # once done, and drop jobs whose id is in the seen set.
+    # There is no max_results cap, every new job is written.
+    # Pass client to run against a fake bigquery.Client.
+    if client is None:
+        client = gcp_clients.bigquery_client(projectid)
+    # Watermark is the newest creation time seen and the ids of jobs
+    # already written (job id -> creation time), empty on the first run
+    watermark = read_json(watermark_file,
+                          {"last_creation_time": None, "seen_jobs": {}})
+    seen = watermark["seen_jobs"]
+    utc = datetime.timezone.utc
+    if watermark["last_creation_time"]:
+        last = datetime.datetime.fromisoformat(
+            watermark["last_creation_time"])
+        min_time = last - datetime.timedelta(hours=lookback_hours)
+    else:
+        last = None
+        min_time = (datetime.datetime.now(utc)
+                    - datetime.timedelta(hours=hours))
+    timings = {}
+    newest = [last]
+
+    def mark_seen(record):
+        # Jobs are only marked seen once written
+        seen[record["job_id"]] = record["created"]
+        created = datetime.datetime.fromisoformat(record["created"])
+        if newest[0] is None or created > newest[0]:
+            newest[0] = created
+
+    count = write_results(iter_query_jobs(client, min_time, None, workers,
+                                          retries, timings,
+                                          state_filter='done',
+                                          skip_job=lambda job:
+                                          job.job_id in seen),
+                          output_format, 'a', timings, mark_seen)
+    last = newest[0]
+    if last is not None:
+        # Ids older than the next run's listing window can be forgotten
+        cutoff = last - datetime.timedelta(hours=lookback_hours)
+        watermark["seen_jobs"] = {
+            job_id: created for job_id, created in seen.items()
+            if datetime.datetime.fromisoformat(created) >= cutoff}
+        watermark["last_creation_time"] = last.isoformat()
+    write_json(watermark_file, watermark)
+    timings['jobs'] = count
+    print_timings(count, timings)
+    return timings
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
                         description=__doc__,
@@ -99,5 +393,53 @@ if __name__ == '__main__':
         default=500,
         help=('Provide a number for max results returned, 500 is default')
         )
+    parser.add_argument(
+        '--workers',
+        required=False,
+        default=8,
+        help=('Number of parallel get_job calls, 8 is default')
+        )
+    parser.add_argument(
+        '--retries',
+        required=False,
+        default=5,
+        help=('Retries for rate limited API calls, 5 is default')
+        )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help=('Only fetch jobs finished since the previous run, '
+              'see --watermark_file')
+        )
+    parser.add_argument(
+        '--watermark_file',
+        required=False,
+        default='bq_monitor_watermark.json',
+        help=('Where --incremental keeps state between runs')
+        )
+    parser.add_argument(
+        '--lookback_hours',
+        required=False,
+        default=6,
+        help=('How far before the watermark --incremental lists jobs, '
+              '6 is default')
+        )
+    parser.add_argument(
+        '--output_format',
+        required=False,
+        default='ndjson',
+        choices=sorted(EXTENSIONS),
+        help=('Format of the job records file, ndjson is default')
+        )
+    gcp_instrumentation.add_arguments(parser)
     args = parser.parse_args()
-    get_data(args.projectid, args.hours, int(args.max_results))
+    gcp_instrumentation.install_from_args(args)
+    if args.incremental:
+        get_incremental_data(args.projectid, args.watermark_file,
+                             int(args.hours), int(args.lookback_hours),
+                             int(args.workers), int(args.retries),
+                             output_format=args.output_format)
+    else:
+        get_data(args.projectid, int(args.hours), int(args.max_results),
+                 int(args.workers), int(args.retries),
+                 output_format=args.output_format)
@@ -1,13 +1,20 @@
-from google.cloud import bigquery
-client = bigquery.Client()
+import bq_table_reader
+import gcp_clients
+client = gcp_clients.bigquery_client()
 
 dataset_ref = client.dataset('samples', project='bigquery-public-data')
 table_ref = dataset_ref.table('shakespeare')
 table = client.get_table(table_ref)  # API call
 
-# Load all rows from a table
-rows = client.list_rows(table)
-assert len(list(rows)) == table.num_rows
+# Count the rows of a table from its metadata, no rows are read
+num_rows = bq_table_reader.count_rows(client, table)
+
+# Load all rows from a table, in ranges read in parallel (see bq_table_reader)
+# and check them against the metadata count
+rows_read = 0
+for batch in bq_table_reader.iter_batches(client, table, range_size=50000):
+    rows_read += len(batch)
+assert rows_read == num_rows
 
 # Load the first 10 rows
 rows = client.list_rows(table, max_results=10)
@@ -6,17 +6,44 @@ too many tables being created and Bigquery Storage costs are high.
 This code could help in getting metadata on a periodic basis and take correctives actions as required.
 Table has an attribute called insertDatetime which represents the datetime when this metadata is captured.
 You can get snapshot of that day based insertDatetime.
+The crawl (crawl_inventory) can be imported and reused. Datasets are listed
+and tables fetched concurrently (--workers, --dataset_workers), API calls are
+capped with a client side rate limiter (--rate) and quota errors retried
+with backoff. Progress and throughput are printed while it runs.
+With --incremental a local index (--snapshot_index) keeps the last seen
+version of every table. Tables unchanged according to the dataset's
+__TABLES__ view (last_modified_time, size_bytes) are skipped without a
+get_table call and only created, changed and deleted tables are written,
+with changeType CREATED / CHANGED / DELETED. --snapshot_at rebuilds the
+full inventory for any insertDatetime from those change rows.
+Existing inventory tables need the changeType column added, e.g.
+ALTER TABLE ... ADD COLUMN changeType STRING.
+With --backend information_schema the metadata of a dataset comes from one
+INFORMATION_SCHEMA.TABLES / __TABLES__ query instead of a get_table call per
+table, with --regions one region level query (TABLES, TABLE_STORAGE) covers
+every dataset of the region. The API path is the fallback when a query fails.
+Partitioning columns then hold the DDL PARTITION BY expression and
+lastModifiedTime the storage last modified time.
+--benchmark compares API calls and wall time of the backends on a local fake.
+Rows are written while the crawl continues: streaming inserts batched by
+rows and bytes (--batch_rows, --batch_bytes) with failed rows retried, or
+with --write_mode load one load job from a local NDJSON file, cheaper and
+faster for large inventories.
 
 """
-from google.cloud.bigquery import client
-from google.cloud.bigquery import dataset as bq_dataset
-# from google.cloud.bigquery import table as bq_table
-# from google.cloud.bigquery.schema import SchemaField
-from google.cloud.bigquery import Table
-from google.oauth2 import service_account
-# import json
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from datetime import timezone
+import argparse
+import re
+import threading
+import time
+from gcp_retry import call_with_retry, RateLimiter
+from bq_writer import BufferedRowWriter, LoadJobWriter
+from record_writers import read_json, write_json
+import gcp_clients
+import gcp_instrumentation
 
 # Details of the GCP Project for which you would like to see all details (metadata) of tables
 PROJECT_ID = "YOUR-PROJECT-ID"
@@ -31,8 +58,9 @@ TABLE_ID = "bq_table_inventory"
 
 def create_table(schema_file_name):
     # Creates table named bq_table_inventory to store metadata
-    credentials2 = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_KEY_FILE_PATH2)
-    ct_bigquery_client = client.Client(project=PROJECT_ID2, credentials=credentials2)
+    from google.cloud.bigquery import Table
+
+    ct_bigquery_client = gcp_clients.bigquery_client(PROJECT_ID2, SERVICE_ACCOUNT_KEY_FILE_PATH2)
     table1 = Table.from_string(PROJECT_ID2 + "." + DATASET_ID + "." + TABLE_ID)
     table1.schema = prepare_schema(schema_file_name)
     table1.partitioning_type = 'DAY'
@@ -42,6 +70,8 @@ def create_table(schema_file_name):
 def prepare_schema(schema_file_name):
     # name with full path or relative path from current directory if schema file not in same directory
     # It reads table.schema file in this code, file expected to be in same directory
+    from google.cloud.bigquery import client
+
     table_schema = []
     try:
         f = open(schema_file_name)
@@ -69,57 +99,593 @@ def prepare_schema(schema_file_name):
     return table_schema
 
 
-# Starts here
-create_table("table.schema")
-credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_KEY_FILE_PATH)
-bq_client = client.Client(project=PROJECT_ID, credentials=credentials)
-# get the list of all datasets in the intended project
-dataset_list = bq_client.list_datasets(project=PROJECT_ID)
-
-# Iterate over each dataset in the project
-for i_dataset in dataset_list:
-    v_dataset = bq_dataset.DatasetReference(project=PROJECT_ID, dataset_id=i_dataset.dataset_id)
-    print("Processing Dataset : {}".format(i_dataset.dataset_id))
-    table_list = bq_client.list_tables(dataset=v_dataset)
-    # if table_list.page_number > 0:
-    print("Processing Tables metadata")
-    # table_metadata holds dictionary of table attributes one dict per table
-    table_metadata = []
+class CrawlStats(object):
+    # Progress counters shared by the crawler threads
+    def __init__(self):
+        self.start = time.time()
+        self.datasets_total = 0
+        self.datasets_done = 0
+        self.tables = 0
+        self.unchanged = 0
+        self.api_calls = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        return ("Datasets {}/{} tables {} ({:.1f} tables/s) unchanged {} "
+                "api calls {} ({:.1f} calls/s) retries {} elapsed {:.1f}s".format(
+                    self.datasets_done, self.datasets_total, self.tables,
+                    self.tables / elapsed, self.unchanged, self.api_calls,
+                    self.api_calls / elapsed, self.retries, elapsed))
+
+
+def table_attributes(table):
+    # One inventory row per table, see table.schema
+    created = None
+    expires = None
+    modified = None
+    # Datetime is converted to String to avoid serialization errors.
+    if table.created:
+        created = (table.created).strftime("%Y-%m-%d %H:%M:%S")
+    if table.modified:
+        modified = (table.modified).strftime("%Y-%m-%d %H:%M:%S")
+    if table.expires:
+        expires = (table.expires).strftime("%Y-%m-%d %H:%M:%S")
+    return {"insertDatetime": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+            "tableID": table.table_id,
+            "projectId": table.project,
+            "datasetId": table.dataset_id,
+            "numBytes": table.num_bytes,
+            "timePartitioning": str(table.time_partitioning),
+            "rangePartitioning": str(table.range_partitioning),
+            "clustering": table.clustering_fields,
+            "created": created,
+            "expires": expires,
+            "tableType": table.table_type,
+            "numRows": table.num_rows,
+            "lastModifiedTime": modified,
+            "location": table.location
+            # "numLongTermBytes": table.numLongTermBytes
+            }
+
+
+def _api_call(fn, limiter, stats, retries, *args, endpoint=None, **kwargs):
+    # Every API call goes through the rate limiter and retries quota errors,
+    # endpoint names it for gcp_instrumentation (time waiting for the
+    # rate limiter is not counted as call latency)
+    def counted_retry(exc):
+        stats.add(retries=1)
+        if endpoint is not None:
+            gcp_instrumentation.record_retry(endpoint, exc)
+
+    def limited(*a, **kw):
+        limiter.acquire()
+        stats.add(api_calls=1)
+        if endpoint is None:
+            return fn(*a, **kw)
+        return gcp_instrumentation.call(endpoint, fn, *a, **kw)
+
+    return call_with_retry(limited, *args, retries=retries,
+                           on_retry=counted_retry, **kwargs)
+
+
+def _table_key(project, dataset_id, table_id):
+    return project + "." + dataset_id + "." + table_id
+
+
+def _millis(dt):
+    if dt is None:
+        return None
+    return int(round(dt.timestamp() * 1000))
+
+
+def _change_markers(bq_client, project, dataset_id, limiter, stats, retries):
+    # list_tables does not return last modified time or size, __TABLES__
+    # has both for every table of the dataset in one metadata query
+    sql = "SELECT table_id, last_modified_time, size_bytes FROM `{}.{}.__TABLES__`".format(
+        project, dataset_id)
+    try:
+        rows = _api_call(lambda: list(bq_client.query(sql).result()),
+                         limiter, stats, retries, endpoint='bigquery.query(__TABLES__)')
+    except Exception as exc:
+        print("Unable to read __TABLES__ of {}, using get_table: {}".format(dataset_id, exc))
+        return {}
+    return {row.table_id: (int(row.last_modified_time), int(row.size_bytes))
+            for row in rows}
+
+
+def _same_version(entry, last_modified_ms, num_bytes):
+    return (entry is not None and entry["lastModifiedMs"] == last_modified_ms
+            and entry["numBytes"] == num_bytes)
+
+
+def _deleted_rows(snapshot_index, keys):
+    # Last known row of each deleted table, marked DELETED
+    rows = []
+    for key in keys:
+        row = dict(snapshot_index[key]["row"])
+        row["insertDatetime"] = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        row["changeType"] = "DELETED"
+        rows.append(row)
+    return rows
+
+
+def api_backend(bq_client, project, dataset_id, table_pool, limiter, stats,
+                retries, snapshot_index=None):
+    # Per table API path: list_tables, then get_table for every table on
+    # the table pool. With a snapshot_index get_table is skipped for tables
+    # that __TABLES__ shows as unchanged.
+    # Returns (keys of all tables listed, [(key, row, version)]) where
+    # version is (lastModifiedMs, numBytes) of the row.
+    v_dataset = project + "." + dataset_id
+    # list_tables pages lazily, the whole listing is one retried call
+    table_list = _api_call(lambda: list(bq_client.list_tables(dataset=v_dataset)),
+                           limiter, stats, retries, endpoint='bigquery.tables.list')
+    markers = {}
+    if snapshot_index is not None:
+        markers = _change_markers(bq_client, project, dataset_id, limiter,
+                                  stats, retries)
+    listed = set()
+    futures = []
     for i_table in table_list:
-        table = bq_client.get_table(i_table.reference)
-        created = None
-        expires = None
-        # Datetime is converted to String to avoid serialization errors.
-        if table.created:
-            created = (table.created).strftime("%Y-%m-%d %H:%M:%S")
-            modified = (table.modified).strftime("%Y-%m-%d %H:%M:%S")
-        if table.expires:
-            expires = (table.expires).strftime("%Y-%m-%d %H:%M:%S")
-        table_attributes = {"insertDatetime": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
-                            "tableID": table.table_id,
-                            "projectId": table.project,
-                            "datasetId": table.dataset_id,
-                            "numBytes": table.num_bytes,
-                            "timePartitioning": str(table.time_partitioning),
-                            "rangePartitioning": str(table.range_partitioning),
-                            "clustering": table.clustering_fields,
-                            "created": created,
-                            "expires": expires,
-                            "tableType": table.table_type,
-                            "numRows": table.num_rows,
-                            "lastModifiedTime": modified,
-                            "location": table.location
-                            # "numLongTermBytes": table.numLongTermBytes
-                            }
-        table_metadata.append(table_attributes)
-    # Write data for dataset to bigquery tables
-    # Bigquery Streaming Inserts
-    print("Writing data for tables in dataset {}".format(i_dataset.dataset_id))
-    if len(table_metadata) > 0:
-        bq_client.insert_rows_json(
-            PROJECT_ID + "." + DATASET_ID + "." + TABLE_ID + "$" + datetime.now(timezone.utc).strftime("%Y%m%d"),
-            table_metadata,
-            # row_ids=[None] * len(table_metadata)
-        )  # Make an API request.
-        print("Inserted data for tables in dataset {} total rows inserted {}".format(i_dataset.dataset_id,
-                                                                                     len(table_metadata)))
+        key = _table_key(project, dataset_id, i_table.table_id)
+        listed.add(key)
+        marker = markers.get(i_table.table_id)
+        if (snapshot_index is not None and marker is not None
+                and _same_version(snapshot_index.get(key), *marker)):
+            stats.add(unchanged=1)
+            continue
+        futures.append((key, table_pool.submit(_api_call, bq_client.get_table,
+                                               limiter, stats, retries,
+                                               i_table.reference,
+                                               endpoint='bigquery.tables.get')))
+    tables = []
+    for key, future in futures:
+        try:
+            table = future.result()
+        except Exception as exc:
+            # e.g. table deleted since it was listed
+            print("Unable to get table metadata: {}".format(exc))
+            continue
+        stats.add(tables=1)
+        tables.append((key, table_attributes(table),
+                       (_millis(table.modified), table.num_bytes)))
+    return listed, tables
+
+
+# INFORMATION_SCHEMA / __TABLES__ columns mapped onto table.schema by
+# information_schema_row. Region level views cover every dataset of the
+# region, TABLE_STORAGE only exists at region level so a dataset query
+# takes sizes from __TABLES__ instead.
+REGION_QUERY = """SELECT
+  t.table_schema AS dataset_id, t.table_name AS table_id, t.table_type,
+  t.creation_time, t.ddl, s.total_logical_bytes AS num_bytes,
+  s.total_rows AS num_rows, s.storage_last_modified_time AS last_modified_time,
+  o.option_value AS expiration
+FROM `{project}.region-{region}.INFORMATION_SCHEMA.TABLES` t
+LEFT JOIN `{project}.region-{region}.INFORMATION_SCHEMA.TABLE_STORAGE` s
+  ON s.table_schema = t.table_schema AND s.table_name = t.table_name
+LEFT JOIN `{project}.region-{region}.INFORMATION_SCHEMA.TABLE_OPTIONS` o
+  ON o.table_schema = t.table_schema AND o.table_name = t.table_name
+  AND o.option_name = 'expiration_timestamp'"""
+
+DATASET_QUERY = """SELECT
+  t.table_schema AS dataset_id, t.table_name AS table_id, t.table_type,
+  t.creation_time, t.ddl, m.size_bytes AS num_bytes, m.row_count AS num_rows,
+  TIMESTAMP_MILLIS(m.last_modified_time) AS last_modified_time,
+  o.option_value AS expiration
+FROM `{project}.{dataset}.INFORMATION_SCHEMA.TABLES` t
+LEFT JOIN `{project}.{dataset}.__TABLES__` m ON m.table_id = t.table_name
+LEFT JOIN `{project}.{dataset}.INFORMATION_SCHEMA.TABLE_OPTIONS` o
+  ON o.table_name = t.table_name AND o.option_name = 'expiration_timestamp'"""
+
+# INFORMATION_SCHEMA table_type to the API's tableType
+TABLE_TYPES = {"BASE TABLE": "TABLE", "CLONE": "TABLE",
+               "MATERIALIZED VIEW": "MATERIALIZED_VIEW"}
+_DDL_PARTITION = re.compile(r"^PARTITION BY (.+?);?$", re.M)
+_DDL_CLUSTER = re.compile(r"^CLUSTER BY (.+?);?$", re.M)
+
+
+def information_schema_row(project, row, location):
+    # One inventory row per table, same columns as table_attributes.
+    # Partitioning is the PARTITION BY expression of the table's DDL
+    # (the API path stores str(TimePartitioning) instead).
+    def fmt(dt):
+        return dt.strftime("%Y-%m-%d %H:%M:%S") if dt else None
+
+    ddl = row.ddl or ""
+    partition = _DDL_PARTITION.search(ddl)
+    partition = partition.group(1) if partition else None
+    cluster = _DDL_CLUSTER.search(ddl)
+    expires = None
+    if row.expiration:
+        # option_value looks like TIMESTAMP "2024-01-01T00:00:00.000Z"
+        expires = row.expiration.split('"')[1][:19].replace("T", " ")
+    range_partitioned = partition is not None and "RANGE_BUCKET" in partition.upper()
+    return {"insertDatetime": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+            "tableID": row.table_id,
+            "projectId": project,
+            "datasetId": row.dataset_id,
+            "numBytes": row.num_bytes,
+            "timePartitioning": str(None if range_partitioned else partition),
+            "rangePartitioning": str(partition if range_partitioned else None),
+            "clustering": ([c.strip().strip("`") for c in cluster.group(1).split(",")]
+                           if cluster else None),
+            "created": fmt(row.creation_time),
+            "expires": expires,
+            "tableType": TABLE_TYPES.get(row.table_type, row.table_type),
+            "numRows": row.num_rows,
+            "lastModifiedTime": fmt(row.last_modified_time),
+            "location": location
+            }
+
+
+def _query_tables(bq_client, project, sql, limiter, stats, retries):
+    # Runs an INFORMATION_SCHEMA query, returns dataset_id -> [(key, row, version)]
+    def run():
+        job = bq_client.query(sql)
+        return job, list(job.result())
+
+    job, rows = _api_call(run, limiter, stats, retries,
+                          endpoint='bigquery.query(INFORMATION_SCHEMA)')
+    datasets = {}
+    for row in rows:
+        key = _table_key(project, row.dataset_id, row.table_id)
+        datasets.setdefault(row.dataset_id, []).append(
+            (key, information_schema_row(project, row, job.location),
+             (_millis(row.last_modified_time), row.num_bytes)))
+    return datasets
+
+
+def information_schema_backend(bq_client, project, dataset_id, table_pool,
+                               limiter, stats, retries, snapshot_index=None):
+    # One query per dataset replaces list_tables and all get_table calls.
+    # Falls back to the API path when the query fails (e.g. permissions).
+    sql = DATASET_QUERY.format(project=project, dataset=dataset_id)
+    try:
+        tables = _query_tables(bq_client, project, sql, limiter, stats,
+                               retries).get(dataset_id, [])
+    except Exception as exc:
+        print("INFORMATION_SCHEMA query failed for {}, using API: {}".format(dataset_id, exc))
+        return api_backend(bq_client, project, dataset_id, table_pool, limiter,
+                           stats, retries, snapshot_index)
+    stats.add(tables=len(tables))
+    return {key for key, _, _ in tables}, tables
+
+
+def region_backend(regions):
+    # Backend running one query per region for every dataset in it, on
+    # first use. Datasets not found in those regions (other regions, no
+    # tables) or a failed region query fall back to one query per dataset.
+    lock = threading.Lock()
+    by_dataset = {}
+    fetched = []
+
+    def backend(bq_client, project, dataset_id, table_pool, limiter, stats,
+                retries, snapshot_index=None):
+        with lock:
+            if not fetched:
+                for region in regions:
+                    sql = REGION_QUERY.format(project=project, region=region)
+                    try:
+                        by_dataset.update(_query_tables(bq_client, project, sql,
+                                                        limiter, stats, retries))
+                    except Exception as exc:
+                        print("INFORMATION_SCHEMA query failed for region {}: {}".format(region, exc))
+                fetched.append(True)
+        if dataset_id not in by_dataset:
+            return information_schema_backend(bq_client, project, dataset_id,
+                                              table_pool, limiter, stats,
+                                              retries, snapshot_index)
+        tables = by_dataset.pop(dataset_id)
+        stats.add(tables=len(tables))
+        return {key for key, _, _ in tables}, tables
+
+    return backend
+
+
+def _crawl_dataset(backend, bq_client, project, dataset_id, table_pool,
+                   limiter, stats, retries, dataset_index=None):
+    # Gets the tables of a dataset from backend.
+    # With a dataset_index (the snapshot index entries of this dataset,
+    # only read here) only created, changed and deleted tables are
+    # returned (with changeType), along with the index updates: key ->
+    # new entry, or None for a deleted table.
+    listed, tables = backend(bq_client, project, dataset_id, table_pool,
+                             limiter, stats, retries, dataset_index)
+    if dataset_index is None:
+        return [row for _, row, _ in tables], {}
+    table_metadata = []
+    updates = {}
+    for key, row, version in tables:
+        entry = dataset_index.get(key)
+        if _same_version(entry, *version):
+            stats.add(unchanged=1)
+            continue
+        row["changeType"] = "CHANGED" if entry else "CREATED"
+        updates[key] = {"lastModifiedMs": version[0],
+                        "numBytes": version[1],
+                        "row": row}
+        table_metadata.append(row)
+    deleted = [key for key in dataset_index if key not in listed]
+    table_metadata.extend(_deleted_rows(dataset_index, deleted))
+    updates.update((key, None) for key in deleted)
+    return table_metadata, updates
+
+
+def _dataset_indexes(snapshot_index, project):
+    # dataset_id -> {key: entry} of the snapshot index entries of project
+    indexes = {}
+    for key, entry in snapshot_index.items():
+        if key.startswith(project + "."):
+            dataset_id = key[len(project) + 1:].split(".", 1)[0]
+            indexes.setdefault(dataset_id, {})[key] = entry
+    return indexes
+
+
+def _apply_updates(snapshot_index, updates):
+    for key, entry in updates.items():
+        if entry is None:
+            snapshot_index.pop(key, None)
+        else:
+            snapshot_index[key] = entry
+
+
+def crawl_inventory(bq_client, project, workers=16, dataset_workers=4,
+                    rate=None, retries=5, progress_seconds=10,
+                    snapshot_index=None, backend=api_backend):
+    # Yields (dataset_id, table_metadata) as datasets complete.
+    # dataset_workers datasets are listed at a time while get_table
+    # calls for all of them run on a pool of workers threads.
+    # rate caps API calls per second across threads, quota errors are
+    # retried with backoff. Progress is printed every progress_seconds.
+    # Pass a snapshot_index (table key -> lastModifiedMs, numBytes and
+    # last inventory row, kept with record_writers read_json / write_json)
+    # to get change rows only, get_table is skipped for tables unchanged
+    # since the index.
+    # The dataset threads only read their part of the index, it is
+    # updated here as each dataset completes.
+    # backend gets the tables of one dataset: api_backend (list_tables and
+    # get_table), information_schema_backend or region_backend(regions).
+    stats = CrawlStats()
+    limiter = RateLimiter(rate)
+    # get the list of all datasets in the intended project
+    dataset_list = _api_call(lambda: list(bq_client.list_datasets(project=project)),
+                             limiter, stats, retries, endpoint='bigquery.datasets.list')
+    stats.datasets_total = len(dataset_list)
+    dataset_indexes = None
+    if snapshot_index is not None:
+        dataset_indexes = _dataset_indexes(snapshot_index, project)
+    last_report = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as table_pool, \
+            ThreadPoolExecutor(max_workers=dataset_workers) as dataset_pool:
+        futures = {}
+        for i_dataset in dataset_list:
+            dataset_index = None
+            if dataset_indexes is not None:
+                dataset_index = dataset_indexes.pop(i_dataset.dataset_id, {})
+            futures[dataset_pool.submit(_crawl_dataset, backend, bq_client, project,
+                                        i_dataset.dataset_id, table_pool,
+                                        limiter, stats, retries,
+                                        dataset_index)] = i_dataset.dataset_id
+        for future in as_completed(futures):
+            stats.add(datasets_done=1)
+            table_metadata, updates = future.result()
+            if snapshot_index is not None:
+                _apply_updates(snapshot_index, updates)
+            yield futures[future], table_metadata
+            if time.time() - last_report >= progress_seconds:
+                print(stats.report())
+                last_report = time.time()
+    if dataset_indexes:
+        # Tables of datasets that no longer exist
+        for dataset_id, dataset_index in dataset_indexes.items():
+            rows = _deleted_rows(dataset_index, list(dataset_index))
+            _apply_updates(snapshot_index, dict.fromkeys(dataset_index))
+            yield dataset_id, rows
+    print(stats.report())
+
+
+def snapshot_query():
+    # Full inventory as of insertDatetime @as_of: latest row of every table
+    # up to @as_of unless it was deleted.
+    # Works for rows from full runs (no changeType) and change rows.
+    return """SELECT * EXCEPT(rn) FROM (
+  SELECT *, ROW_NUMBER() OVER (
+    PARTITION BY projectId, datasetId, tableID ORDER BY insertDatetime DESC) AS rn
+  FROM `{}.{}.{}`
+  WHERE SAFE.PARSE_DATETIME('%Y-%m-%d %H:%M:%S', insertDatetime) <= @as_of)
+WHERE rn = 1 AND IFNULL(changeType, '') != 'DELETED'""".format(
+        PROJECT_ID2, DATASET_ID, TABLE_ID)
+
+
+def snapshot_job_config(as_of):
+    # as_of ("YYYY-MM-DD HH:MM:SS" or "YYYY-MM-DD") as the DATETIME query
+    # parameter @as_of, a malformed value raises ValueError
+    from google.cloud import bigquery
+
+    return bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("as_of", "DATETIME",
+                                      datetime.fromisoformat(as_of))])
+
+
+def rebuild_snapshot(bq_client, as_of):
+    # Writes the inventory as of as_of to a local NDJSON file
+    job_config = snapshot_job_config(as_of)
+    filename = "bq_table_inventory_snapshot_" + "".join(c for c in as_of if c.isdigit()) + ".json"
+    with open(filename, 'w') as f:
+        for row in bq_client.query(snapshot_query(), job_config=job_config).result():
+            f.write(json.dumps(dict(row.items()), default=str) + "\n")
+    print("Snapshot as of {} written to {}".format(as_of, filename))
+
+
+def benchmark(datasets=20, tables=500, latency=0.02, query_latency=1.0,
+              workers=16):
+    # Crawls an in-process fake project with each backend and prints API
+    # calls and wall time. latency / query_latency are the simulated
+    # seconds per API call / per query.
+    import gcp_fakes
+
+    results = []
+    for name, backend in (("api", api_backend),
+                          ("information_schema", information_schema_backend),
+                          ("region", region_backend(["us"]))):
+        fake = gcp_fakes.FakeBigQueryClient(
+            tables=gcp_fakes.make_tables(datasets, tables),
+            latency=latency, query_latency=query_latency)
+        start = time.time()
+        rows = sum(len(table_metadata) for _, table_metadata in crawl_inventory(
+            fake, fake.project, workers, progress_seconds=3600, backend=backend))
+        results.append((name, rows, sum(fake.calls.values()), dict(fake.calls),
+                        time.time() - start))
+    for name, rows, calls, by_method, seconds in results:
+        print("{:<19} rows {:>7} api calls {:>7} wall time {:>7.2f}s {}".format(
+            name, rows, calls, seconds, by_method))
+
+
+def inventory_writer(write_mode='stream', max_rows=500, max_bytes=5000000,
+                     retries=5):
+    # Writer for today's partition of the inventory table.
+    # stream: Bigquery Streaming Inserts, batched and flushed in background
+    # load: rows go to a local NDJSON file loaded with one load job
+    w_bigquery_client = gcp_clients.bigquery_client(PROJECT_ID2, SERVICE_ACCOUNT_KEY_FILE_PATH2)
+    table = PROJECT_ID2 + "." + DATASET_ID + "." + TABLE_ID + "$" + datetime.now(timezone.utc).strftime("%Y%m%d")
+    if write_mode == 'load':
+        return LoadJobWriter(w_bigquery_client, table)
+    return BufferedRowWriter(w_bigquery_client, table, max_rows, max_bytes,
+                             retries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--workers',
+        required=False,
+        default=16,
+        help=('Number of parallel get_table calls, 16 is default')
+        )
+    parser.add_argument(
+        '--dataset_workers',
+        required=False,
+        default=4,
+        help=('Number of datasets listed in parallel, 4 is default')
+        )
+    parser.add_argument(
+        '--rate',
+        required=False,
+        default=None,
+        help=('Max API calls per second, no limit by default')
+        )
+    parser.add_argument(
+        '--retries',
+        required=False,
+        default=5,
+        help=('Retries for quota / rate limit errors, 5 is default')
+        )
+    parser.add_argument(
+        '--backend',
+        required=False,
+        default='api',
+        choices=['api', 'information_schema'],
+        help=('api: list_tables and get_table per table (default), '
+              'information_schema: one metadata query per dataset or region')
+        )
+    parser.add_argument(
+        '--regions',
+        required=False,
+        help=('Comma separated regions (e.g. us,eu) for one '
+              'INFORMATION_SCHEMA query per region')
+        )
+    parser.add_argument(
+        '--benchmark',
+        action='store_true',
+        help=('Compare the backends against an in-process fake project')
+        )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help=('Write only created, changed and deleted tables, '
+              'see --snapshot_index')
+        )
+    parser.add_argument(
+        '--snapshot_index',
+        required=False,
+        default='bq_table_inventory_index.json',
+        help=('Local index of the last seen version of every table')
+        )
+    parser.add_argument(
+        '--write_mode',
+        required=False,
+        default='stream',
+        choices=['stream', 'load'],
+        help=('stream: batched streaming inserts (default), '
+              'load: one load job from a local NDJSON file')
+        )
+    parser.add_argument(
+        '--batch_rows',
+        required=False,
+        default=500,
+        help=('Max rows per streaming insert request, 500 is default')
+        )
+    parser.add_argument(
+        '--batch_bytes',
+        required=False,
+        default=5000000,
+        help=('Max bytes per streaming insert request, 5000000 is default')
+        )
+    parser.add_argument(
+        '--snapshot_at',
+        required=False,
+        help=('Rebuild the full inventory as of this insertDatetime '
+              '(YYYY-MM-DD HH:MM:SS) instead of crawling')
+        )
+    gcp_instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    gcp_instrumentation.install_from_args(args)
+    if args.benchmark:
+        benchmark(workers=int(args.workers))
+        raise SystemExit(0)
+    if args.snapshot_at:
+        rebuild_snapshot(gcp_clients.bigquery_client(PROJECT_ID2, SERVICE_ACCOUNT_KEY_FILE_PATH2),
+                         args.snapshot_at)
+        raise SystemExit(0)
+    # Starts here
+    create_table("table.schema")
+    bq_client = gcp_clients.bigquery_client(PROJECT_ID, SERVICE_ACCOUNT_KEY_FILE_PATH,
+                                            pool_size=int(args.workers) + int(args.dataset_workers))
+    snapshot_index = None
+    if args.incremental:
+        snapshot_index = read_json(args.snapshot_index, {})
+    backend = api_backend
+    if args.backend == 'information_schema':
+        backend = information_schema_backend
+        if args.regions:
+            backend = region_backend(args.regions.split(","))
+    writer = inventory_writer(args.write_mode, int(args.batch_rows),
+                              int(args.batch_bytes), int(args.retries))
+    for dataset_id, table_metadata in crawl_inventory(
+            bq_client, PROJECT_ID, int(args.workers),
+            int(args.dataset_workers),
+            float(args.rate) if args.rate else None, int(args.retries),
+            snapshot_index=snapshot_index, backend=backend):
+        print("Processed Dataset : {} rows {}".format(dataset_id, len(table_metadata)))
+        writer.add(table_metadata)
+    writer.close()
+    print("Total rows inserted {} failed {}".format(writer.rows_written,
+                                                    len(writer.failed_rows)))
+    for failed in writer.failed_rows:
+        print("Failed row {} errors {}".format(failed["row"]["tableID"], failed["errors"]))
+    if snapshot_index is not None:
+        if writer.failed_rows:
+            # Keep the old index so the failed changes are found again
+            print("Not updating {} because rows failed".format(args.snapshot_index))
+        else:
+            write_json(args.snapshot_index, snapshot_index)
@@ -0,0 +1,205 @@
+"""Parallel reader for whole BigQuery tables.
+
+The table is split into row ranges of --range_size rows using its
+num_rows metadata, and the ranges are read with list_rows(start_index,
+max_results) on a pool of --workers threads. Up to --prefetch ranges are
+requested ahead of the one being consumed, so reading overlaps with the
+caller's processing. Batches (a list of rows per range) or rows come out
+in table order, or as soon as they arrive with ordered=False.
+selected_fields limits the columns read.
+
+count_rows reads the row count from the table metadata only. Rows still
+in the streaming buffer are not counted, and rows added after the reader
+starts are not read.
+
+Usage:
+    import bq_table_reader
+    for batch in bq_table_reader.iter_batches(client, 'project.dataset.table',
+                                              selected_fields=['word']):
+        ...
+
+Run with --benchmark to compare with one sequential list_rows on a fake.
+"""
+import argparse
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from gcp_retry import call_with_retry
+import gcp_clients
+
+
+def get_table(client, table):
+    # Table object of a Table, a TableReference or 'project.dataset.table'
+    if hasattr(table, 'num_rows') and hasattr(table, 'schema'):
+        return table
+    return call_with_retry(client.get_table, table,
+                           endpoint='bigquery.tables.get')
+
+
+def count_rows(client, table):
+    # Metadata only, no rows are read
+    return get_table(client, table).num_rows
+
+
+def row_ranges(num_rows, range_size=10000):
+    # (start_index, max_results) of every range
+    return [(start, min(range_size, num_rows - start))
+            for start in range(0, num_rows, range_size)]
+
+
+def _fields(table, selected_fields):
+    # SchemaFields of the selected column names (or SchemaFields)
+    if selected_fields is None:
+        return None
+    by_name = {field.name: field for field in table.schema}
+    return [by_name[field] if isinstance(field, str) else field
+            for field in selected_fields]
+
+
+def read_range(client, table, start_index, max_results, selected_fields=None,
+               page_size=None, retries=5):
+    # Rows of one range, a failed range is read again from its start
+    def read():
+        return list(client.list_rows(table, start_index=start_index,
+                                     max_results=max_results,
+                                     selected_fields=selected_fields,
+                                     page_size=page_size))
+    return call_with_retry(read, retries=retries,
+                           endpoint='bigquery.tabledata.list')
+
+
+def iter_batches(client, table, selected_fields=None, range_size=10000,
+                 workers=8, prefetch=None, ordered=True, page_size=None,
+                 retries=5):
+    # Yields the rows of every range as a list. prefetch (default 2 x
+    # workers) ranges are in flight or waiting to be consumed at most.
+    table = get_table(client, table)
+    fields = _fields(table, selected_fields)
+    ranges = collections.deque(row_ranges(table.num_rows, range_size))
+    if prefetch is None:
+        prefetch = 2 * workers
+    prefetch = max(prefetch, 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+
+        def submit():
+            start_index, max_results = ranges.popleft()
+            return pool.submit(read_range, client, table, start_index,
+                               max_results, fields, page_size, retries)
+
+        if ordered:
+            pending = collections.deque()
+            while ranges or pending:
+                while ranges and len(pending) < prefetch:
+                    pending.append(submit())
+                yield pending.popleft().result()
+        else:
+            pending = set()
+            while ranges or pending:
+                while ranges and len(pending) < prefetch:
+                    pending.add(submit())
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+
+def iter_rows(client, table, selected_fields=None, **kwargs):
+    # Same as iter_batches, one row at a time
+    for batch in iter_batches(client, table, selected_fields, **kwargs):
+        for row in batch:
+            yield row
+
+
+def benchmark(num_rows=1000000, latency=0.2, range_size=10000, workers=8,
+              page_size=10000):
+    # Sequential list_rows against iter_batches on a fake table, latency
+    # is the simulated seconds per page
+    import gcp_fakes
+
+    table = gcp_fakes.FakeTable('fake-project', 'dataset', 'table', None,
+                                num_rows=num_rows)
+    fake = gcp_fakes.FakeBigQueryClient(tables=[table], latency=latency)
+    start = time.time()
+    rows = len(fake.list_rows(table, page_size=page_size))
+    print("sequential list_rows     rows {} in {:.2f}s".format(
+        rows, time.time() - start))
+    for ordered in (True, False):
+        start = time.time()
+        rows = sum(len(batch) for batch in iter_batches(
+            fake, table, ['id'], range_size, workers, ordered=ordered,
+            page_size=page_size))
+        print("iter_batches ordered={:<5} rows {} in {:.2f}s".format(
+            str(ordered), rows, time.time() - start))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--table',
+        required=False,
+        help=('Table to read, project.dataset.table')
+        )
+    parser.add_argument(
+        '--fields',
+        required=False,
+        default=None,
+        help=('Comma separated columns to read, all by default')
+        )
+    parser.add_argument(
+        '--range_size',
+        required=False,
+        default=10000,
+        help=('Rows per range, 10000 is default')
+        )
+    parser.add_argument(
+        '--workers',
+        required=False,
+        default=8,
+        help=('Ranges read in parallel, 8 is default')
+        )
+    parser.add_argument(
+        '--prefetch',
+        required=False,
+        default=None,
+        help=('Ranges read ahead, 2 x workers is default')
+        )
+    parser.add_argument(
+        '--unordered',
+        required=False,
+        action='store_true',
+        help=('Yield ranges as they arrive instead of in table order')
+        )
+    parser.add_argument(
+        '--count',
+        required=False,
+        action='store_true',
+        help=('Only print the row count, from the table metadata')
+        )
+    parser.add_argument(
+        '--benchmark',
+        required=False,
+        action='store_true',
+        help=('Compare with sequential list_rows on a fake table')
+        )
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(range_size=int(args.range_size), workers=int(args.workers))
+    elif args.table:
+        client = gcp_clients.bigquery_client(pool_size=int(args.workers))
+        if args.count:
+            print(count_rows(client, args.table))
+        else:
+            fields = None
+            if args.fields:
+                fields = args.fields.split(',')
+            prefetch = None
+            if args.prefetch:
+                prefetch = int(args.prefetch)
+            start = time.time()
+            rows = sum(len(batch) for batch in iter_batches(
+                client, args.table, fields, int(args.range_size),
+                int(args.workers), prefetch, not args.unordered))
+            print("Rows {} in {:.2f}s".format(rows, time.time() - start))
+    else:
+        parser.error('Use --table or --benchmark')
@@ -0,0 +1,177 @@
+"""Buffered writers for loading rows into a BigQuery table.
+
+BufferedRowWriter batches rows by count and bytes and streams them with
+insert_rows_json from a background thread, so the caller keeps producing
+rows while earlier batches are in flight. Errors returned by the API are
+checked: rows that failed for a transient reason (or were stopped because
+another row of the request was invalid) are retried, rows still failing
+are kept in failed_rows.
+
+LoadJobWriter writes rows (or whole dataframes with add_frame) to a local
+NDJSON file and loads it with one load job on close, for large volumes
+where streaming inserts are slower and cost more. Load jobs per table
+per day are limited, so a stream of batches should go through one writer
+rather than a load job per batch.
+
+Both have the same interface: add(rows), close() and the counters
+rows_written and failed_rows.
+"""
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from gcp_retry import call_with_retry
+
+# insert_rows_json error reasons worth sending again
+RETRYABLE_ROW_REASONS = ('backendError', 'internalError', 'timeout', 'stopped')
+
+
+class BufferedRowWriter(object):
+    # Streaming insert limits are 10 MB per request, 500 rows per request
+    # is recommended. Up to queue_batches full batches wait for the
+    # background thread, add() blocks beyond that.
+    def __init__(self, bq_client, table, max_rows=500, max_bytes=5000000,
+                 retries=5, queue_batches=8):
+        self.bq_client = bq_client
+        self.table = table
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.rows_written = 0
+        self.requests = 0
+        self.failed_rows = []
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._queue = queue.Queue(maxsize=queue_batches)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, rows):
+        for row in rows:
+            size = len(json.dumps(row, default=str))
+            if self._buffer and (len(self._buffer) >= self.max_rows
+                                 or self._buffer_bytes + size > self.max_bytes):
+                self.flush()
+            # Stable insertId so a retried request is de-duplicated
+            self._buffer.append((str(uuid.uuid4()), row))
+            self._buffer_bytes += size
+
+    def flush(self):
+        if self._error is not None:
+            raise self._error
+        if self._buffer:
+            self._queue.put(self._buffer)
+            self._buffer = []
+            self._buffer_bytes = 0
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            if self._error is not None:
+                # keep draining so producers never block on a dead writer
+                continue
+            try:
+                self._insert(batch)
+            except Exception as exc:
+                self._error = exc
+
+    def _insert(self, batch):
+        attempt = 0
+        while batch:
+            self.requests += 1
+            errors = call_with_retry(self.bq_client.insert_rows_json,
+                                     self.table, [row for _, row in batch],
+                                     row_ids=[row_id for row_id, _ in batch],
+                                     retries=self.retries,
+                                     endpoint='bigquery.tabledata.insertAll')
+            failed = {}
+            for error in errors:
+                failed[error["index"]] = error.get("errors", [])
+            self.rows_written += len(batch) - len(failed)
+            retry = []
+            for index, row_errors in failed.items():
+                reasons = {e.get("reason") for e in row_errors}
+                if attempt < self.retries and reasons <= set(RETRYABLE_ROW_REASONS):
+                    retry.append(batch[index])
+                else:
+                    self.failed_rows.append({"row": batch[index][1],
+                                             "errors": row_errors})
+            batch = retry
+            if batch:
+                time.sleep(min(32, 2 ** attempt))
+                attempt += 1
+
+
+class LoadJobWriter(object):
+    # Rows go to a local NDJSON file (path, a temp file by default),
+    # close() loads it into table with one load job and removes the file.
+    # write_disposition WRITE_TRUNCATE replaces the table. schema is a
+    # list of (name, type) for a table that may not exist yet.
+    def __init__(self, bq_client, table, path=None,
+                 write_disposition='WRITE_APPEND', schema=None):
+        self.bq_client = bq_client
+        self.table = table
+        self.write_disposition = write_disposition
+        self.schema = schema
+        if path is None:
+            handle, path = tempfile.mkstemp(prefix="bq_load_", suffix=".json")
+            os.close(handle)
+        self.path = path
+        self.rows_written = 0
+        self.failed_rows = []
+        self._rows = 0
+        self._file = open(path, 'w')
+
+    def add(self, rows):
+        for row in rows:
+            self._file.write(json.dumps(row, default=str) + "\n")
+            self._rows += 1
+
+    def add_frame(self, frame):
+        # All rows of a pandas dataframe, serialized in one call
+        if len(frame) == 0:
+            return
+        text = frame.to_json(orient='records', lines=True, date_format='iso',
+                             double_precision=15)
+        self._file.write(text if text.endswith("\n") else text + "\n")
+        self._rows += len(frame)
+
+    def abort(self):
+        # Drops the rows written so far without loading them
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        from google.cloud import bigquery
+
+        self._file.close()
+        if self._rows == 0:
+            os.remove(self.path)
+            return
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=self.write_disposition)
+        if self.schema is not None:
+            job_config.schema = [bigquery.SchemaField(name, field_type)
+                                 for name, field_type in self.schema]
+        with open(self.path, 'rb') as f:
+            job = self.bq_client.load_table_from_file(f, self.table,
+                                                      job_config=job_config)
+        # result() raises if the load job failed, the file is kept then
+        job.result()
+        self.rows_written = self._rows
+        os.remove(self.path)
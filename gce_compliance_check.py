@@ -8,6 +8,11 @@ important ones for compliance check
 3. status
 5. service accounts
 
+Instances of all zones are read with instances().aggregatedList and a
+fields= mask, so only name, creation date and status come over the wire. When
+aggregatedList is not allowed (or with --mode zones) zones are listed in
+parallel (--workers), each worker thread with its own service object.
+
 This code uses application default credentials.
 You need to setup environment variable with correct service account
 export GOOGLE_APPLICATION_CREDENTIALS=FULL_PATH_OF_SRVCE_ACCNT_KEY_JSON_FILE
@@ -15,24 +20,31 @@ export GOOGLE_APPLICATION_CREDENTIALS=FULL_PATH_OF_SRVCE_ACCNT_KEY_JSON_FILE
 
 import json
 import argparse
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+from concurrent.futures import ThreadPoolExecutor
+import gcp_clients
+import gcp_instrumentation
+from gcp_retry import call_with_retry, status_code
+
+# Only these instance attributes are requested (fields= mask)
+INSTANCE_FIELDS = 'name,creationTimestamp,status'
 
 
 def get_service():
-    credentials = GoogleCredentials.get_application_default()
-    service = discovery.build('compute', 'v1', credentials=credentials)
-    return service
+    # Compute service of the calling thread, built once per thread from a
+    # discovery document loaded once per process
+    return gcp_clients.get_service('compute', 'v1')
 
 
 def get_zones(service, project):
     zone_list = []
     # Collect all zone names
-    request = service.zones().list(project=project)
+    request = service.zones().list(project=project,
+                                   fields='items(name),nextPageToken')
     while request is not None:
-        response = request.execute()
+        response = call_with_retry(request.execute,
+                                   endpoint='compute.zones.list')
 
-        for zone in response['items']:
+        for zone in response.get('items', []):
             # Get the list of all zones
             zone_list.append(zone['name'])
 
@@ -42,40 +54,87 @@ def get_zones(service, project):
     return zone_list
 
 
-def get_instance_list(service, project, zone_list):
+def _instance_entry(instance, zone):
+    # 'instance' has only the attributes of interest, see INSTANCE_FIELDS
+    return {"creationTimestamp": instance['creationTimestamp'],
+            "status": instance['status'],
+            "zone": zone}
+
+
+def get_instance_list_aggregated(service, project):
+    # All zones in a few requests with aggregatedList, the fields mask
+    # keeps only the attributes we need in the response
     instance_list = {}
-    # List all instances in each zone
-    for each_zone in zone_list:
-        request = service.instances().list(project=project, zone=each_zone)
-        # print("instance zone is " + each_zone)
-        while request is not None:
-            response = request.execute()
-            # print("Response is: " + str(response))
-            if response.get('items'):
-
-                for instance in response['items']:
-                    # 'instance' has all attributes, select only of interest
-                    # print(instance['name'])
-                    temp_dict = {
-                        "creationTimestamp":
-                            instance['creationTimestamp'],
-                            "status":
-                                instance['status'],
-                                "zone":
-                                    each_zone}
-                    instance_list[instance['name']] = temp_dict
-                    # instance_list.append(temp_dict)
-
-            request = service.instances().list_next(
-                previous_request=request, previous_response=response)
+    request = service.instances().aggregatedList(
+        project=project,
+        fields='items/*/instances({}),nextPageToken'.format(INSTANCE_FIELDS))
+    while request is not None:
+        response = call_with_retry(request.execute,
+                                   endpoint='compute.instances.aggregatedList')
+        # items maps 'zones/ZONE' to the instances of that zone
+        for scope, scoped_list in response.get('items', {}).items():
+            zone = scope.split('/')[-1]
+            for instance in scoped_list.get('instances', []):
+                instance_list[instance['name']] = _instance_entry(instance,
+                                                                  zone)
+        request = service.instances().aggregatedList_next(
+            previous_request=request, previous_response=response)
+    return instance_list
+
+
+def _zone_instances(service, project, zone):
+    instance_list = {}
+    request = service.instances().list(
+        project=project, zone=zone,
+        fields='items({}),nextPageToken'.format(INSTANCE_FIELDS))
+    while request is not None:
+        response = call_with_retry(request.execute,
+                                   endpoint='compute.instances.list')
+        for instance in response.get('items', []):
+            instance_list[instance['name']] = _instance_entry(instance, zone)
+        request = service.instances().list_next(
+            previous_request=request, previous_response=response)
     return instance_list
 
 
-def run(project):
-    service = get_service()
-    zones = get_zones(service, project)
-    instances = get_instance_list(service, project, zones)
+def get_instance_list(service, project, zone_list, workers=16,
+                      service_factory=get_service):
+    # List all instances in each zone, workers zones at a time.
+    # Fallback for when aggregatedList is not allowed.
+    instance_list = {}
+    if workers <= 1:
+        for each_zone in zone_list:
+            instance_list.update(_zone_instances(service, project, each_zone))
+        return instance_list
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for zone_instances in pool.map(
+                lambda zone: _zone_instances(service_factory(), project, zone),
+                zone_list):
+            instance_list.update(zone_instances)
+    return instance_list
+
 
+def scan(project, mode='aggregated', workers=16, service_factory=get_service):
+    # Instance name -> creationTimestamp, status and zone
+    service = service_factory()
+    instances = None
+    if mode == 'aggregated':
+        try:
+            instances = get_instance_list_aggregated(service, project)
+        except Exception as exc:
+            if status_code(exc) not in (400, 403):
+                raise
+            print("aggregatedList not allowed, listing zone by zone: "
+                  "{}".format(exc))
+    if instances is None:
+        zones = get_zones(service, project)
+        instances = get_instance_list(service, project, zones, workers,
+                                      service_factory)
+    return instances
+
+
+def run(project, mode='aggregated', workers=16):
+    instances = scan(project, mode, workers)
     # write results to a temp file
     f = open(project+'_instance_compliance_check.json', 'w')
     f.write(json.dumps(instances))
@@ -91,5 +150,21 @@ if __name__ == '__main__':
         required=True,
         help=('Provide Project Id')
         )
+    parser.add_argument(
+        '--mode',
+        required=False,
+        default='aggregated',
+        choices=['aggregated', 'zones'],
+        help=('aggregated: instances().aggregatedList (default), '
+              'zones: list zone by zone in parallel')
+        )
+    parser.add_argument(
+        '--workers',
+        required=False,
+        default=16,
+        help=('Zones listed in parallel in zones mode, 16 is default')
+        )
+    gcp_instrumentation.add_arguments(parser)
     args = parser.parse_args()
-    run(args.projectid)
+    gcp_instrumentation.install_from_args(args)
+    run(args.projectid, args.mode, int(args.workers))
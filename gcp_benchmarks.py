@@ -0,0 +1,305 @@
+"""Offline benchmark suite of the gcp-utils scripts.
+
+Every benchmark runs a script's own code against the in-process fakes of
+gcp_fakes (BigQuery, Compute, IAM, Pub/Sub), so it needs no project and
+no network access. The scale is set on the command line (--jobs, --tables,
+--zones ...) and --latency adds simulated seconds per API call.
+
+For each benchmark the wall time and the API calls per endpoint recorded
+by gcp_instrumentation are printed, and with --output written as JSON.
+API call counts do not depend on timing, so comparing them with a
+--baseline file from an earlier run catches N+1 call patterns. Wall time
+is compared too, a run more than --tolerance times slower is reported.
+The exit status is 1 when a regression is found.
+
+Benchmarks whose client library is not installed are reported as skipped.
+
+Usage:
+    python gcp_benchmarks.py --output baseline.json
+    python gcp_benchmarks.py --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import gcp_fakes
+import gcp_instrumentation
+
+
+def bigquery_jobs(scale):
+    # bq_query_monitor.get_data over scale['jobs'] query jobs, returns the
+    # number of jobs it wrote
+    import bq_query_monitor
+
+    client = gcp_fakes.FakeBigQueryClient(gcp_fakes.make_jobs(scale['jobs']),
+                                          latency=scale['latency'])
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # get_data writes its files to the current directory
+        os.chdir(directory)
+        try:
+            timings = bq_query_monitor.get_data(client.project,
+                                                max_results=scale['jobs'],
+                                                client=client)
+        finally:
+            os.chdir(cwd)
+    return timings['jobs']
+
+
+def bigquery_inventory(scale):
+    # bq_table_inventory.crawl_inventory over scale['tables'] tables in
+    # scale['datasets'] datasets, per table API path
+    import bq_table_inventory
+
+    client = gcp_fakes.FakeBigQueryClient(
+        tables=gcp_fakes.make_tables(scale['datasets'],
+                                     scale['tables'] // scale['datasets']),
+        latency=scale['latency'])
+    return sum(len(rows) for _, rows in bq_table_inventory.crawl_inventory(
+        client, client.project, progress_seconds=3600))
+
+
+def bigquery_inventory_information_schema(scale):
+    # Same crawl with one INFORMATION_SCHEMA query per dataset
+    import bq_table_inventory
+
+    client = gcp_fakes.FakeBigQueryClient(
+        tables=gcp_fakes.make_tables(scale['datasets'],
+                                     scale['tables'] // scale['datasets']),
+        latency=scale['latency'])
+    return sum(len(rows) for _, rows in bq_table_inventory.crawl_inventory(
+        client, client.project, progress_seconds=3600,
+        backend=bq_table_inventory.information_schema_backend))
+
+
+def bigquery_table_reader(scale):
+    # bq_table_reader.iter_batches over a table of scale['rows'] rows
+    import bq_table_reader
+
+    table = gcp_fakes.FakeTable('fake-project', 'dataset', 'table', None,
+                                num_rows=scale['rows'])
+    client = gcp_fakes.FakeBigQueryClient(tables=[table],
+                                          latency=scale['latency'])
+    return sum(len(batch) for batch in bq_table_reader.iter_batches(
+        client, table, page_size=10000))
+
+
+def _compute_scan(scale, mode):
+    import gce_compliance_check
+
+    service = gcp_fakes.FakeComputeService(scale['zones'],
+                                           scale['instances_per_zone'],
+                                           latency=scale['latency'])
+    return len(gce_compliance_check.scan('fake-project', mode,
+                                         service_factory=lambda: service))
+
+
+def compute_aggregated(scale):
+    # gce_compliance_check.scan with instances().aggregatedList
+    return _compute_scan(scale, 'aggregated')
+
+
+def compute_zones(scale):
+    # gce_compliance_check.scan zone by zone
+    return _compute_scan(scale, 'zones')
+
+
+def _iam_scan(scale, mode):
+    import srvc_acct_key_compliance_check
+
+    service = gcp_fakes.FakeIamService(scale['service_accounts'],
+                                       latency=scale['latency'])
+    return len(srvc_acct_key_compliance_check.scan(
+        'fake-project', mode=mode, service_factory=lambda: service))
+
+
+def iam_keys_batch(scale):
+    # srvc_acct_key_compliance_check.scan with batched keys().list
+    return _iam_scan(scale, 'batch')
+
+
+def iam_keys_pool(scale):
+    # srvc_acct_key_compliance_check.scan with keys().list on a pool
+    return _iam_scan(scale, 'pool')
+
+
+def pubsub_pull(scale):
+    # pubsub_async_puller.benchmark on the fake subscriber (or the
+    # emulator when PUBSUB_EMULATOR_HOST is set), returns the messages acked
+    import pubsub_async_puller
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            acked = pubsub_async_puller.benchmark(count=scale['messages'])
+        finally:
+            os.chdir(cwd)
+    return acked
+
+
+BENCHMARKS = {
+    'bigquery_jobs': bigquery_jobs,
+    'bigquery_inventory': bigquery_inventory,
+    'bigquery_inventory_information_schema': bigquery_inventory_information_schema,
+    'bigquery_table_reader': bigquery_table_reader,
+    'compute_aggregated': compute_aggregated,
+    'compute_zones': compute_zones,
+    'iam_keys_batch': iam_keys_batch,
+    'iam_keys_pool': iam_keys_pool,
+    'pubsub_pull': pubsub_pull,
+}
+
+
+def run(names=None, scale=None):
+    # name -> seconds, items and API calls per endpoint of each benchmark
+    if names is None:
+        names = list(BENCHMARKS)
+    results = {}
+    for name in names:
+        recorder = gcp_instrumentation.install()
+        start = time.time()
+        try:
+            items = BENCHMARKS[name](scale)
+        except ImportError as exc:
+            results[name] = {"skipped": str(exc)}
+            print("{:<38} skipped: {}".format(name, exc))
+            continue
+        finally:
+            gcp_instrumentation.uninstall()
+        seconds = time.time() - start
+        results[name] = {"seconds": round(seconds, 3), "items": items,
+                         "api_calls": sum(recorder.calls().values()),
+                         "endpoints": recorder.to_dict()["endpoints"]}
+        print("{:<38} {:>8} items {:>8.2f}s {:>7} API calls".format(
+            name, items, seconds, results[name]["api_calls"]))
+    return results
+
+
+def regressions(results, baseline, tolerance=1.5):
+    # Messages for benchmarks making more API calls than in baseline, or
+    # running more than tolerance times slower
+    found = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before or "skipped" in result or "skipped" in before:
+            continue
+        if before.get("items") != result["items"]:
+            # different scale, nothing to compare
+            continue
+        for endpoint, stats in result["endpoints"].items():
+            calls_before = before["endpoints"].get(endpoint, {}).get("calls", 0)
+            if stats["calls"] > calls_before:
+                found.append("{} {}: {} API calls, {} in baseline".format(
+                    name, endpoint, stats["calls"], calls_before))
+        if result["seconds"] > before["seconds"] * tolerance and \
+                result["seconds"] - before["seconds"] > 0.5:
+            found.append("{}: {:.2f}s, {:.2f}s in baseline".format(
+                name, result["seconds"], before["seconds"]))
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--benchmarks',
+        required=False,
+        default=','.join(BENCHMARKS),
+        help=('Comma separated benchmarks, default all: '
+              + ', '.join(BENCHMARKS))
+        )
+    parser.add_argument(
+        '--jobs',
+        required=False,
+        default=10000,
+        help=('BigQuery jobs, 10000 is default')
+        )
+    parser.add_argument(
+        '--tables',
+        required=False,
+        default=50000,
+        help=('BigQuery tables, 50000 is default')
+        )
+    parser.add_argument(
+        '--datasets',
+        required=False,
+        default=100,
+        help=('BigQuery datasets the tables are spread over, 100 is default')
+        )
+    parser.add_argument(
+        '--rows',
+        required=False,
+        default=1000000,
+        help=('Rows of the table read by bq_table_reader, 1000000 is default')
+        )
+    parser.add_argument(
+        '--zones',
+        required=False,
+        default=500,
+        help=('Compute zones, 500 is default')
+        )
+    parser.add_argument(
+        '--instances_per_zone',
+        required=False,
+        default=20,
+        help=('Compute instances per zone, 20 is default')
+        )
+    parser.add_argument(
+        '--service_accounts',
+        required=False,
+        default=1000,
+        help=('IAM service accounts, 1000 is default')
+        )
+    parser.add_argument(
+        '--messages',
+        required=False,
+        default=100000,
+        help=('Pub/Sub messages, 100000 is default')
+        )
+    parser.add_argument(
+        '--latency',
+        required=False,
+        default=0.0,
+        help=('Simulated seconds per API call, 0 is default')
+        )
+    parser.add_argument(
+        '--output',
+        required=False,
+        default=None,
+        help=('Write the results to this JSON file')
+        )
+    parser.add_argument(
+        '--baseline',
+        required=False,
+        default=None,
+        help=('Results JSON of an earlier run to compare with')
+        )
+    parser.add_argument(
+        '--tolerance',
+        required=False,
+        default=1.5,
+        help=('Slowdown against the baseline reported as a regression, '
+              '1.5 is default')
+        )
+    args = parser.parse_args()
+    scale = {'jobs': int(args.jobs), 'tables': int(args.tables),
+             'datasets': int(args.datasets), 'rows': int(args.rows),
+             'zones': int(args.zones),
+             'instances_per_zone': int(args.instances_per_zone),
+             'service_accounts': int(args.service_accounts),
+             'messages': int(args.messages), 'latency': float(args.latency)}
+    results = run(args.benchmarks.split(','), scale)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"scale": scale, "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        found = regressions(results, baseline, float(args.tolerance))
+        for message in found:
+            print("Regression: " + message)
+        if found:
+            raise SystemExit(1)
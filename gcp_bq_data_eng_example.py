@@ -17,19 +17,39 @@ Concepts covered:
 This program uses bigquery-public-data, new_york_taxi_trips dataset and tlc_yellow_trips tables
 It retrieves latitude and longitude of pickup location.
 Transformation function get_zipcode finds out the zipcode based on lat and long
+with one Nominatim (OpenStreetMap) request per row, about 1 row per second.
+With --centroids the zipcodes come from the offline zip_geocoder instead,
+a whole column in one vectorized call, so --limit can go to millions of rows.
+--limit 0 reads the whole table.
+
+With --pipeline the rows are read in batches (BigQuery Storage Read API when
+google-cloud-bigquery-storage is installed, else result pages of --page_size)
+and reading, adding zipcodes and writing run as separate threads joined by
+bounded queues of --queue_batches batches. Each batch is appended to the CSV
+file and to a local NDJSON file that is loaded into the table with one load
+job at the end (bq_writer.LoadJobWriter), a load job per batch would run into
+the load jobs per table per day limit on the whole table. The trip counts per
+zipcode are summed batch by batch, so memory stays bounded even over the whole
+tlc_yellow_trips_2016 table.
 Results are stored in file and table
 You should create a dataset named nyc_trip_data_mart
 Replace PROJECT_ID and SERVICE_ACCOUNT_KEY_FILE_PATH with your values
 path to file on windows need to use forward slash (/) like C:/Users/abcd/yourfile.json
 """
 
-import geopy
-import pandas as pd
-import pandas_gbq as bq
-from google.oauth2 import service_account
+import argparse
+import queue
+import threading
+import time
+import gcp_clients
+from bq_writer import LoadJobWriter
 
 PROJECT_ID = "YOUR_GCP_PROJECT_ID"
 SERVICE_ACCOUNT_KEY_FILE_PATH = "PATH_TO_YOUR_JSON_KEY_FILE"
+# Columns of nyc_trip_data_mart.temp_table, zipcode stays a string so
+# leading zeros are kept
+RESULT_SCHEMA = [('vendor_id', 'STRING'), ('pickup_longitude', 'FLOAT'),
+                 ('pickup_latitude', 'FLOAT'), ('zipcode', 'STRING')]
 QUERY_TEXT = """SELECT 
                 vendor_id, 
                 pickup_longitude, 
@@ -38,8 +58,7 @@ QUERY_TEXT = """SELECT
                 WHERE pickup_longitude is not null 
                 and pickup_latitude is not null
                 and pickup_longitude != 0.0
-                and pickup_latitude != 0.0
-                LIMIT 200"""
+                and pickup_latitude != 0.0"""
 
 
 # Function to get the zipcode from latitude and longitude
@@ -49,28 +68,218 @@ def get_zipcode(df, geolocator, lat_field, lon_field):
     return location.raw['address']['postcode']
 
 
-# Initialize geopy
-geo_locator = geopy.Nominatim(user_agent='xyz_app')
-# Get the Google Cloud Credentials for Bigquery
-credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_KEY_FILE_PATH)
-# Run the query on Bigquery using pandas-gbq, returns a dataframe
-result = bq.read_gbq(query=QUERY_TEXT,
-                     project_id=PROJECT_ID,
-                     credentials=credentials)
-# Apply the get_zipcode function to the dataframe, note no iteration
-# A new column is getting added to dataframe with name zipcode
-result['zipcode'] = result.apply(get_zipcode,
-                                 axis=1,
-                                 geolocator=geo_locator,
-                                 lat_field='pickup_latitude',
-                                 lon_field='pickup_longitude')
-# Write the result dataframe to a csv file
-result.to_csv('result_with_zipcodes.csv', index=False)
-# You could write the result dataframe in one go but I putting an example of creation and append
-# Write dataframe to a Bigquery table (only first 100 rows). New table gets created
-bq.to_gbq(result[:100], 'nyc_trip_data_mart.temp_table', project_id=PROJECT_ID)
-# Write next 100 record i.e. append to an existing table
-bq.to_gbq(result[100:], 'nyc_trip_data_mart.temp_table', project_id=PROJECT_ID, if_exists='append')
-# Aggregate: trip counts for each zipcode: select zipcode, count(vendor_id) from table group by zipcode
-agg_result = (result.groupby('zipcode', as_index=False)['vendor_id'].count()).rename(columns = {'vendor_id': 'trip_count'})
-bq.to_gbq(agg_result, 'nyc_trip_data_mart.temp_table_agg', project_id=PROJECT_ID, if_exists='replace')
+def query_text(limit=200):
+    if limit:
+        return QUERY_TEXT + "\n                LIMIT {}".format(limit)
+    return QUERY_TEXT
+
+
+def read_trips(credentials, limit=200):
+    # Run the query on Bigquery using pandas-gbq, returns a dataframe
+    import pandas_gbq as bq
+
+    return bq.read_gbq(query=query_text(limit),
+                       project_id=PROJECT_ID,
+                       credentials=credentials)
+
+
+def add_zipcodes(result, geocoder=None):
+    # A new column is getting added to dataframe with name zipcode
+    if geocoder is not None:
+        # Offline lookup of the whole column in one call
+        result['zipcode'] = geocoder.lookup(
+            result['pickup_latitude'].to_numpy(),
+            result['pickup_longitude'].to_numpy())
+        return result
+    # Initialize geopy
+    import geopy
+
+    geo_locator = geopy.Nominatim(user_agent='xyz_app')
+    # Apply the get_zipcode function to the dataframe, note no iteration
+    result['zipcode'] = result.apply(get_zipcode,
+                                     axis=1,
+                                     geolocator=geo_locator,
+                                     lat_field='pickup_latitude',
+                                     lon_field='pickup_longitude')
+    return result
+
+
+def aggregate(result):
+    # Aggregate: trip counts for each zipcode: select zipcode, count(vendor_id) from table group by zipcode
+    return (result.groupby('zipcode', as_index=False)['vendor_id'].count()).rename(columns = {'vendor_id': 'trip_count'})
+
+
+def read_batches(limit=0, page_size=100000):
+    # Query result as an iterator of dataframes
+    client = gcp_clients.bigquery_client(PROJECT_ID, SERVICE_ACCOUNT_KEY_FILE_PATH)
+    credentials = gcp_clients.get_credentials(SERVICE_ACCOUNT_KEY_FILE_PATH)
+    try:
+        from google.cloud import bigquery_storage
+
+        bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=credentials)
+    except ImportError:
+        bqstorage_client = None
+    rows = client.query(query_text(limit)).result(page_size=page_size)
+    return rows.to_dataframe_iterable(bqstorage_client=bqstorage_client)
+
+
+def _stage(work, inbox, outbox, stop, errors):
+    # Runs work on every batch of inbox and passes the result to outbox.
+    # After an error the stage keeps draining inbox so the stages before
+    # it never block on a full queue.
+    try:
+        while True:
+            batch = inbox.get()
+            if batch is None:
+                break
+            result = work(batch)
+            if outbox is not None:
+                outbox.put(result)
+    except Exception as exc:
+        errors.append(exc)
+        stop.set()
+        while inbox.get() is not None:
+            pass
+    finally:
+        if outbox is not None:
+            outbox.put(None)
+
+
+def pipeline(credentials, geocoder=None, limit=0, page_size=100000, queue_batches=4,
+             csv_path='result_with_zipcodes.csv', batches=None, writer=None):
+    # Streams the query result batch by batch through reader, transform and
+    # writer threads, returns the number of rows written. The rows reach
+    # the table with one load job once every batch is written.
+    import pandas_gbq as bq
+
+    if batches is None:
+        batches = read_batches(limit, page_size)
+    if writer is None:
+        writer = LoadJobWriter(gcp_clients.bigquery_client(PROJECT_ID, SERVICE_ACCOUNT_KEY_FILE_PATH),
+                               'nyc_trip_data_mart.temp_table',
+                               write_disposition='WRITE_TRUNCATE', schema=RESULT_SCHEMA)
+    to_transform = queue.Queue(maxsize=queue_batches)
+    to_write = queue.Queue(maxsize=queue_batches)
+    stop = threading.Event()
+    errors = []
+    state = {'batches': 0, 'rows': 0, 'counts': None}
+
+    def write(batch):
+        first = state['batches'] == 0
+        # Header only with the first batch, every batch is appended
+        batch.to_csv(csv_path, index=False, header=first, mode='w' if first else 'a')
+        writer.add_frame(batch)
+        counts = batch.groupby('zipcode')['vendor_id'].count()
+        if state['counts'] is None:
+            state['counts'] = counts
+        else:
+            state['counts'] = state['counts'].add(counts, fill_value=0)
+        state['batches'] += 1
+        state['rows'] += len(batch)
+        print("Batch {} rows {} total {}".format(state['batches'], len(batch), state['rows']))
+
+    threads = [threading.Thread(target=_stage, args=(lambda batch: add_zipcodes(batch, geocoder),
+                                                     to_transform, to_write, stop, errors)),
+               threading.Thread(target=_stage, args=(write, to_write, None, stop, errors))]
+    for thread in threads:
+        thread.start()
+    start = time.time()
+    try:
+        for batch in batches:
+            if stop.is_set():
+                break
+            to_transform.put(batch)
+    except Exception as exc:
+        errors.append(exc)
+    finally:
+        to_transform.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        writer.abort()
+        raise errors[0]
+    # One load job for all the rows, it replaces the table
+    writer.close()
+    if state['counts'] is not None:
+        agg_result = state['counts'].astype('int64').rename('trip_count').reset_index()
+        bq.to_gbq(agg_result, 'nyc_trip_data_mart.temp_table_agg', project_id=PROJECT_ID,
+                  if_exists='replace', credentials=credentials)
+    seconds = time.time() - start
+    print("Rows {} in {:.1f}s, {:.0f} rows/s".format(state['rows'], seconds,
+                                                    state['rows'] / max(seconds, 1e-9)))
+    return state['rows']
+
+
+def main(limit=200, centroids=None, max_km=10.0, streaming=False, page_size=100000,
+         queue_batches=4):
+    geocoder = None
+    if centroids:
+        from zip_geocoder import ZipGeocoder
+
+        geocoder = ZipGeocoder.from_file(centroids, max_km=max_km)
+    # Get the Google Cloud Credentials for Bigquery
+    credentials = gcp_clients.get_credentials(SERVICE_ACCOUNT_KEY_FILE_PATH)
+    if streaming:
+        pipeline(credentials, geocoder, limit, page_size, queue_batches)
+        return
+    import pandas_gbq as bq
+
+    result = add_zipcodes(read_trips(credentials, limit), geocoder)
+    # Write the result dataframe to a csv file
+    result.to_csv('result_with_zipcodes.csv', index=False)
+    # You could write the result dataframe in one go but I putting an example of creation and append
+    # Write dataframe to a Bigquery table (only first 100 rows). New table gets created
+    bq.to_gbq(result[:100], 'nyc_trip_data_mart.temp_table', project_id=PROJECT_ID, credentials=credentials)
+    # Write the remaining records i.e. append to an existing table
+    bq.to_gbq(result[100:], 'nyc_trip_data_mart.temp_table', project_id=PROJECT_ID, if_exists='append', credentials=credentials)
+    agg_result = aggregate(result)
+    bq.to_gbq(agg_result, 'nyc_trip_data_mart.temp_table_agg', project_id=PROJECT_ID, if_exists='replace', credentials=credentials)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--limit',
+        required=False,
+        default=200,
+        help=('Trips read, 200 is default, 0 for all')
+        )
+    parser.add_argument(
+        '--centroids',
+        required=False,
+        default=None,
+        help=('ZIP centroid file for offline geocoding (see zip_geocoder), '
+              'Nominatim is used without it')
+        )
+    parser.add_argument(
+        '--max_km',
+        required=False,
+        default=10,
+        help=('Offline geocoding: no zipcode beyond this distance, '
+              '10 is default')
+        )
+    parser.add_argument(
+        '--pipeline',
+        required=False,
+        action='store_true',
+        help=('Stream the rows in batches through reader, transform and '
+              'writer threads')
+        )
+    parser.add_argument(
+        '--page_size',
+        required=False,
+        default=100000,
+        help=('Rows per batch with --pipeline when the Storage Read API is '
+              'not used, 100000 is default')
+        )
+    parser.add_argument(
+        '--queue_batches',
+        required=False,
+        default=4,
+        help=('Batches waiting between stages with --pipeline, 4 is default')
+        )
+    args = parser.parse_args()
+    main(int(args.limit), args.centroids, float(args.max_km), args.pipeline,
+         int(args.page_size), int(args.queue_batches))
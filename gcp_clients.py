@@ -0,0 +1,132 @@
+"""Process wide cache of Google API clients and credentials for the gcp-utils
+scripts.
+
+Credentials are loaded once per process, application default credentials
+or a service account key file, and shared by every client built from
+them, so their access token is fetched once and refreshed in one place.
+
+BigQuery clients are cached per (project, key file) and share one
+requests session per credentials whose connection pool holds pool_size
+connections (requests keeps 10 by default, fewer than the worker pools of
+the scripts, which then keep opening new connections). The pool holds the
+largest pool_size asked for so far, a caller asking for more grows it.
+The session counts response bytes for gcp_instrumentation.
+
+discovery.build fetches (or reads) and parses the API discovery document
+on every call. Here each document is loaded once per process and every
+thread builds its service from it once, so scanning many projects on a
+worker pool pays that cost once per thread instead of once per project.
+Services are kept per thread because httplib2 is not thread safe.
+
+The client libraries are imported on first use only, importing this
+module costs nothing. Startup time of a script can be checked with
+    python -X importtime -c "import bq_query_monitor" 2>&1 | tail -1
+"""
+import threading
+import gcp_instrumentation
+
+CLOUD_PLATFORM_SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
+
+_lock = threading.RLock()
+_documents = {}
+_credentials = {}
+_sessions = {}
+_pool_sizes = {}
+_bigquery_clients = {}
+_thread_state = threading.local()
+
+
+def get_credentials(key_file=None):
+    # Application default credentials, or the service account of
+    # key_file, shared by every client
+    with _lock:
+        if key_file not in _credentials:
+            if key_file is None:
+                import google.auth
+
+                credentials, _ = google.auth.default(
+                    scopes=[CLOUD_PLATFORM_SCOPE])
+            else:
+                from google.oauth2 import service_account
+
+                credentials = service_account.Credentials.from_service_account_file(
+                    key_file, scopes=[CLOUD_PLATFORM_SCOPE])
+            _credentials[key_file] = credentials
+    return _credentials[key_file]
+
+
+def authorized_session(key_file=None, pool_size=32):
+    # requests session with a connection pool of at least pool_size,
+    # shared by the clients using the same credentials
+    with _lock:
+        if key_file not in _sessions:
+            from google.auth.transport.requests import AuthorizedSession
+
+            session = AuthorizedSession(get_credentials(key_file))
+            session.hooks['response'].append(gcp_instrumentation.response_hook)
+            _sessions[key_file] = session
+            _pool_sizes[key_file] = 0
+        if pool_size > _pool_sizes[key_file]:
+            from requests.adapters import HTTPAdapter
+
+            # Requests in flight finish on the adapter they started on
+            _sessions[key_file].mount('https://', HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size))
+            _pool_sizes[key_file] = pool_size
+    return _sessions[key_file]
+
+
+def bigquery_client(project=None, key_file=None, pool_size=32):
+    # google.cloud.bigquery Client, thread safe and shared by every caller.
+    # Its session pool grows to pool_size if an earlier caller asked for
+    # fewer connections.
+    with _lock:
+        session = authorized_session(key_file, pool_size)
+        if (project, key_file) not in _bigquery_clients:
+            from google.cloud import bigquery
+
+            _bigquery_clients[(project, key_file)] = bigquery.Client(
+                project=project, credentials=get_credentials(key_file),
+                _http=session)
+    return _bigquery_clients[(project, key_file)]
+
+
+def discovery_document(api, version):
+    # Discovery document text, from the copy bundled with
+    # google-api-python-client when there is one, else downloaded once
+    with _lock:
+        if (api, version) not in _documents:
+            from googleapiclient import discovery
+
+            document = None
+            try:
+                from googleapiclient import discovery_cache
+
+                document = discovery_cache.get_static_doc(api, version)
+            except (ImportError, AttributeError):
+                pass
+            if document is None:
+                import httplib2
+
+                uri = discovery.DISCOVERY_URI.format(api=api,
+                                                     apiVersion=version)
+                response, document = httplib2.Http().request(uri)
+                if response.status >= 400:
+                    raise RuntimeError('Unable to get discovery document '
+                                       '{} {}: {}'.format(api, version,
+                                                          response.status))
+            _documents[(api, version)] = document
+    return _documents[(api, version)]
+
+
+def get_service(api, version):
+    # Service for the calling thread, built once from the cached document
+    services = getattr(_thread_state, 'services', None)
+    if services is None:
+        services = _thread_state.services = {}
+    if (api, version) not in services:
+        from googleapiclient import discovery
+
+        services[(api, version)] = discovery.build_from_document(
+            discovery_document(api, version), credentials=get_credentials())
+    return services[(api, version)]
@@ -0,0 +1,130 @@
+"""Runs the compliance checks over many projects in one process.
+
+Projects come from --projects (comma separated) or --project_file (one
+project id per line, # for comments). Every (project, check) pair runs on
+a worker pool (--workers) and shares the per process discovery documents
+and per thread services of gcp_clients, so the startup and discovery cost
+is paid once instead of once per project.
+
+Results are written as they come in, one JSON record per line, to
+compliance_scan_YYYY-MM-DD.json (or .json.gz with --output_format gzip):
+gce_instances         one record per instance (see gce_compliance_check)
+service_account_keys  one record per service account with its keys, their
+                      age and expiry (see srvc_acct_key_compliance_check)
+A project whose check fails gets a record with an error field instead.
+
+This code uses application default credentials.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import gce_compliance_check
+import gcp_instrumentation
+import srvc_acct_key_compliance_check
+from record_writers import RecordWriter
+
+
+def gce_instances(project):
+    instances = gce_compliance_check.scan(project, workers=1)
+    for name, instance in instances.items():
+        record = {"name": name}
+        record.update(instance)
+        yield record
+
+
+def service_account_keys(project):
+    accounts = srvc_acct_key_compliance_check.scan(project)
+    for account, entry in accounts.items():
+        record = {"account": account}
+        record.update(entry)
+        yield record
+
+
+CHECKS = {
+    'gce_instances': gce_instances,
+    'service_account_keys': service_account_keys,
+}
+
+
+def read_projects(projects=None, project_file=None):
+    project_list = []
+    if projects:
+        project_list.extend(p.strip() for p in projects.split(',')
+                            if p.strip())
+    if project_file:
+        with open(project_file) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    project_list.append(line)
+    return project_list
+
+
+def _run_check(check, project):
+    # Records of one check for one project, errors become a record
+    try:
+        return [dict(project=project, check=check, **record)
+                for record in CHECKS[check](project)]
+    except Exception as exc:
+        return [{"project": project, "check": check, "error": str(exc)}]
+
+
+def scan(project_list, checks=None, workers=8, output_format='ndjson'):
+    # Runs checks for every project, writes records as each finishes.
+    # Returns the number of records written.
+    if checks is None:
+        checks = list(CHECKS)
+    with RecordWriter('compliance_scan_', output_format) as writer, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_run_check, check, project): (project, check)
+                   for project in project_list for check in checks}
+        for future in as_completed(futures):
+            project, check = futures[future]
+            records = future.result()
+            for record in records:
+                writer.write(record)
+            print("Project {} check {} records {}".format(project, check,
+                                                         len(records)))
+    return writer.count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--projects',
+        required=False,
+        help=('Comma separated project ids')
+        )
+    parser.add_argument(
+        '--project_file',
+        required=False,
+        help=('File with one project id per line')
+        )
+    parser.add_argument(
+        '--checks',
+        required=False,
+        default=','.join(CHECKS),
+        help=('Comma separated checks, default all: ' + ', '.join(CHECKS))
+        )
+    parser.add_argument(
+        '--workers',
+        required=False,
+        default=8,
+        help=('Checks run in parallel, 8 is default')
+        )
+    parser.add_argument(
+        '--output_format',
+        required=False,
+        default='ndjson',
+        choices=['ndjson', 'gzip'],
+        help=('Format of the output file, ndjson is default')
+        )
+    gcp_instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    gcp_instrumentation.install_from_args(args)
+    project_list = read_projects(args.projects, args.project_file)
+    if not project_list:
+        parser.error('Provide --projects or --project_file')
+    scan(project_list, args.checks.split(','), int(args.workers),
+         args.output_format)
@@ -0,0 +1,621 @@
+"""In-process fakes of the Google Cloud clients used by gcp-utils.
+
+They implement just the calls the scripts make, keep everything in memory
+and count the API calls made against them, so the scripts can be run and
+timed without a GCP project or network access, e.g.
+
+    import bq_query_monitor, gcp_fakes
+    client = gcp_fakes.FakeBigQueryClient(gcp_fakes.make_jobs(10000))
+    bq_query_monitor.get_data('fake-project', client=client)
+    print(client.calls)
+"""
+import collections
+import copy
+import datetime
+import re
+import threading
+import time
+
+
+class FakeJob(object):
+    # Same attribute names as google.cloud.bigquery QueryJob
+    def __init__(self, job_id, created, duration=1.0, query='SELECT 1',
+                 job_type='query', state='DONE', project='fake-project',
+                 location='US', total_bytes_billed=0,
+                 total_bytes_processed=0, cache_hit=False,
+                 referenced_tables=(), user_email='user@example.com'):
+        self.job_id = job_id
+        self.project = project
+        self.location = location
+        self.job_type = job_type
+        self.state = state
+        self.created = created
+        self.started = created
+        self.ended = None
+        if state == 'DONE':
+            self.ended = created + datetime.timedelta(seconds=duration)
+        self.query = query
+        self.total_bytes_billed = total_bytes_billed
+        self.total_bytes_processed = total_bytes_processed
+        self.cache_hit = cache_hit
+        self.referenced_tables = list(referenced_tables)
+        self.user_email = user_email
+
+
+def make_jobs(count, end=None, hours=24, listing_complete=0.9):
+    # count query jobs spread evenly over the hours before end.
+    # The first listing_complete share of jobs has full statistics in
+    # list_jobs, the rest need a get_job call.
+    if end is None:
+        end = datetime.datetime.now(datetime.timezone.utc)
+    step = datetime.timedelta(hours=hours) / max(count, 1)
+    jobs = []
+    for i in range(count):
+        job = FakeJob('job_{:08d}'.format(i), end - step * (count - i),
+                      duration=1.0 + i % 60,
+                      query="SELECT name, total FROM dataset.table_{} "
+                            "WHERE id = {}".format(i % 50, i),
+                      total_bytes_billed=(i % 100) * 10 ** 6,
+                      total_bytes_processed=(i % 100) * 10 ** 6)
+        job.listing_complete = i < count * listing_complete
+        jobs.append(job)
+    return jobs
+
+
+class FakeRow(dict):
+    # Query result row, by key or attribute like google.cloud.bigquery Row
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeQueryJob(object):
+    def __init__(self, rows, location='US'):
+        self.rows = rows
+        self.location = location
+
+    def result(self):
+        return self.rows
+
+
+FakeSchemaField = collections.namedtuple('FakeSchemaField', 'name field_type')
+
+
+class FakeTable(object):
+    # Same attribute names as google.cloud.bigquery Table
+    def __init__(self, project, dataset_id, table_id, modified, num_bytes=0,
+                 num_rows=0, table_type='TABLE', location='US'):
+        self.project = project
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.reference = (project, dataset_id, table_id)
+        self.created = modified
+        self.modified = modified
+        self.expires = None
+        self.num_bytes = num_bytes
+        self.num_rows = num_rows
+        self.table_type = table_type
+        self.time_partitioning = None
+        self.range_partitioning = None
+        self.clustering_fields = None
+        self.location = location
+        self.schema = [FakeSchemaField('id', 'INTEGER'),
+                       FakeSchemaField('name', 'STRING')]
+
+
+def make_tables(datasets, tables_per_dataset, project='fake-project'):
+    # datasets x tables_per_dataset tables named dataset_NNN.table_NNNNN
+    modified = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    return [FakeTable(project, 'dataset_{:03d}'.format(d),
+                      'table_{:05d}'.format(t), modified,
+                      num_bytes=t * 1000, num_rows=t)
+            for d in range(datasets) for t in range(tables_per_dataset)]
+
+
+class FakeDatasetListItem(object):
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+
+
+class FakeTableListItem(object):
+    def __init__(self, table):
+        self.table_id = table.table_id
+        self.reference = table.reference
+
+
+_REGION_SQL = re.compile(r"`([^`]+)\.region-([^.`]+)\.INFORMATION_SCHEMA\.TABLES`")
+_DATASET_SQL = re.compile(r"`([^`]+)\.([^.`]+)\.(?:INFORMATION_SCHEMA\.TABLES|__TABLES__)`")
+
+
+class FakePageIterator(object):
+    # Items or pages of a list call, like google.api_core HTTPIterator,
+    # pages are fetched lazily
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __iter__(self):
+        for page in self.pages:
+            for item in page:
+                yield item
+
+
+class FakeBigQueryClient(object):
+    # Holds jobs and tables in memory, calls counts the API calls per
+    # method. list calls are counted once per page of 1000 like the API,
+    # every call sleeps latency seconds (query_latency for queries) to
+    # stand in for a round trip.
+    def __init__(self, jobs=(), project='fake-project', tables=(),
+                 latency=0.0, query_latency=None):
+        self.project = project
+        self.jobs = {job.job_id: job for job in jobs}
+        self.tables = {}
+        for table in tables:
+            self.add_table(table)
+        self.latency = latency
+        self.query_latency = latency if query_latency is None else query_latency
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, method):
+        with self._lock:
+            self.calls[method] += 1
+
+    def add_job(self, job):
+        self.jobs[job.job_id] = job
+
+    def list_jobs(self, min_creation_time=None, max_results=None,
+                  state_filter=None, all_users=None, **kwargs):
+        # Newest first like the API
+        listed = sorted(self.jobs.values(), key=lambda j: j.created,
+                        reverse=True)
+        if min_creation_time is not None:
+            if min_creation_time.tzinfo is None:
+                min_creation_time = min_creation_time.replace(
+                    tzinfo=datetime.timezone.utc)
+            listed = [j for j in listed if j.created >= min_creation_time]
+        if state_filter is not None:
+            listed = [j for j in listed if j.state.lower() == state_filter]
+        if max_results is not None:
+            listed = listed[:max_results]
+        return FakePageIterator(self._job_pages(listed))
+
+    def _job_pages(self, listed):
+        for start in range(0, len(listed), 1000):
+            self._count('list_jobs')
+            time.sleep(self.latency)
+            page = []
+            for job in listed[start:start + 1000]:
+                if getattr(job, 'listing_complete', True):
+                    page.append(job)
+                else:
+                    partial = copy.copy(job)
+                    partial.query = None
+                    page.append(partial)
+            yield page
+
+    def get_job(self, job_id, project=None, location=None, **kwargs):
+        self._count('get_job')
+        time.sleep(self.latency)
+        return self.jobs[job_id]
+
+    def add_table(self, table):
+        self.tables.setdefault(table.dataset_id, {})[table.table_id] = table
+
+    def list_datasets(self, project=None, **kwargs):
+        self._count('list_datasets')
+        time.sleep(self.latency)
+        return [FakeDatasetListItem(d) for d in sorted(self.tables)]
+
+    def list_tables(self, dataset, **kwargs):
+        # dataset is a DatasetReference or 'project.dataset_id'
+        dataset_id = getattr(dataset, 'dataset_id', None)
+        if dataset_id is None:
+            dataset_id = dataset.split('.')[-1]
+        tables = sorted(self.tables.get(dataset_id, {}).values(),
+                        key=lambda t: t.table_id)
+        for i in range(0, max(len(tables), 1), 1000):
+            self._count('list_tables')
+            time.sleep(self.latency)
+        return [FakeTableListItem(t) for t in tables]
+
+    def get_table(self, reference, **kwargs):
+        self._count('get_table')
+        time.sleep(self.latency)
+        if isinstance(reference, str):
+            reference = reference.split('.')
+        project, dataset_id, table_id = reference
+        return self.tables[dataset_id][table_id]
+
+    def list_rows(self, table, start_index=0, max_results=None,
+                  selected_fields=None, page_size=None, **kwargs):
+        # Rows id, name of table (num_rows of them), one call and one
+        # latency per page of page_size rows (default 10000)
+        if isinstance(table, str):
+            table = self.get_table(table)
+        end = table.num_rows
+        if max_results is not None:
+            end = min(end, start_index + max_results)
+        fields = [field.name for field in selected_fields or table.schema]
+        page_size = page_size or 10000
+        rows = []
+        for page_start in range(start_index, max(end, start_index + 1),
+                                page_size):
+            self._count('list_rows')
+            time.sleep(self.latency)
+            for i in range(page_start, min(end, page_start + page_size)):
+                row = FakeRow(id=i, name='row_{}'.format(i))
+                rows.append(FakeRow((name, row[name]) for name in fields))
+        return rows
+
+    def _information_schema_row(self, table):
+        return FakeRow(dataset_id=table.dataset_id, table_id=table.table_id,
+                       table_type='BASE TABLE', creation_time=table.created,
+                       ddl='CREATE TABLE `{}.{}.{}`\n(\n  id INT64\n);'.format(
+                           table.project, table.dataset_id, table.table_id),
+                       num_bytes=table.num_bytes, num_rows=table.num_rows,
+                       last_modified_time=table.modified, expiration=None,
+                       size_bytes=table.num_bytes,
+                       row_count=table.num_rows)
+
+    def query(self, sql, **kwargs):
+        # Answers the INFORMATION_SCHEMA and __TABLES__ queries of
+        # bq_table_inventory
+        self._count('query')
+        time.sleep(self.query_latency)
+        region = _REGION_SQL.search(sql)
+        if region:
+            datasets = sorted(self.tables)
+            location = region.group(2).upper()
+        else:
+            datasets = [_DATASET_SQL.search(sql).group(2)]
+            location = 'US'
+        rows = []
+        for dataset_id in datasets:
+            for table in self.tables.get(dataset_id, {}).values():
+                row = self._information_schema_row(table)
+                if 'INFORMATION_SCHEMA' not in sql:
+                    # __TABLES__ has last_modified_time in ms
+                    row['last_modified_time'] = int(round(
+                        table.modified.timestamp() * 1000))
+                rows.append(row)
+        return FakeQueryJob(rows, location)
+
+
+class FakeMessage(object):
+    # Same attribute names as a pubsub_v1 subscriber Message
+    def __init__(self, data, message_id, subscription):
+        self.data = data
+        self.message_id = message_id
+        self.attributes = {}
+        self.publish_time = datetime.datetime.now(datetime.timezone.utc)
+        self.size = len(data)
+        self.delivery_attempt = None
+        self._subscription = subscription
+
+    def ack(self):
+        self._subscription.done(self, acked=True)
+
+    def nack(self):
+        self._subscription.done(self, acked=False)
+
+
+class FakeStreamingPullFuture(object):
+    def __init__(self):
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def done(self):
+        return self._cancelled.is_set()
+
+    def result(self, timeout=None):
+        self._cancelled.wait(timeout)
+
+
+class FakeSubscription(object):
+    # Messages not delivered yet, nacked messages go back in the queue
+    def __init__(self):
+        self.messages = collections.deque()
+        self.acked = 0
+        self.nacked = 0
+        self.lock = threading.Condition()
+
+    def done(self, message, acked):
+        with self.lock:
+            if acked:
+                self.acked += 1
+            else:
+                self.nacked += 1
+                self.messages.append(message)
+            message.stream.release(message)
+            self.lock.notify_all()
+
+
+class _FakeStream(object):
+    # Outstanding messages of one subscribe() call, for flow control
+    def __init__(self, flow_control):
+        self.max_messages = getattr(flow_control, 'max_messages', 1000)
+        self.max_bytes = getattr(flow_control, 'max_bytes', 100 * 1024 * 1024)
+        self.messages = 0
+        self.bytes = 0
+
+    def has_room(self, message):
+        if self.messages == 0:
+            return True
+        return (self.messages < self.max_messages
+                and self.bytes + message.size <= self.max_bytes)
+
+    def hold(self, message):
+        self.messages += 1
+        self.bytes += message.size
+
+    def release(self, message):
+        self.messages -= 1
+        self.bytes -= message.size
+
+
+class FakeFlowControl(object):
+    # pubsub_v1.types.FlowControl, the limits _FakeStream reads
+    def __init__(self, max_messages=1000, max_bytes=100 * 1024 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+
+class FakeThreadScheduler(object):
+    # pubsub_v1 ThreadScheduler, callbacks run on executor
+    def __init__(self, executor=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=10)
+        self._executor = executor
+
+    def schedule(self, callback, *args, **kwargs):
+        self._executor.submit(callback, *args, **kwargs)
+
+    def shutdown(self, await_msg_callbacks=False):
+        self._executor.shutdown(wait=await_msg_callbacks)
+
+
+class FakeSubscriberClient(object):
+    # Delivers messages published with publish() to the callbacks of
+    # subscribe(), honouring flow_control (max_messages, max_bytes) per
+    # stream like the streaming pull of pubsub_v1. Callbacks run on
+    # scheduler.schedule() when a scheduler is given, else on a pool of
+    # 10 threads like the default scheduler.
+    def __init__(self):
+        self.subscriptions = collections.defaultdict(FakeSubscription)
+        self.calls = collections.Counter()
+        self._ids = 0
+
+    def subscription_path(self, project, subscription):
+        return 'projects/{}/subscriptions/{}'.format(project, subscription)
+
+    def publish(self, subscription_path, data):
+        subscription = self.subscriptions[subscription_path]
+        with subscription.lock:
+            self._ids += 1
+            subscription.messages.append(
+                FakeMessage(data, str(self._ids), subscription))
+            subscription.lock.notify_all()
+
+    def subscribe(self, subscription_path, callback, flow_control=None,
+                  scheduler=None, **kwargs):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.calls['subscribe'] += 1
+        future = FakeStreamingPullFuture()
+        executor = None
+        if scheduler is None:
+            executor = ThreadPoolExecutor(max_workers=10)
+        thread = threading.Thread(
+            target=self._stream, daemon=True,
+            args=(self.subscriptions[subscription_path], callback,
+                  _FakeStream(flow_control), scheduler, executor, future))
+        thread.start()
+        return future
+
+    def _stream(self, subscription, callback, stream, scheduler, executor,
+                future):
+        while not future.cancelled():
+            with subscription.lock:
+                if (not subscription.messages
+                        or not stream.has_room(subscription.messages[0])):
+                    subscription.lock.wait(0.05)
+                    continue
+                message = subscription.messages.popleft()
+                message.stream = stream
+                stream.hold(message)
+            if scheduler is not None:
+                scheduler.schedule(callback, message)
+            else:
+                executor.submit(callback, message)
+        if scheduler is not None:
+            scheduler.shutdown()
+        else:
+            executor.shutdown(wait=False)
+
+
+class FakeRequest(object):
+    # googleapiclient HttpRequest, execute() counts the call under method,
+    # sleeps the service latency and returns handler(**kwargs)
+    def __init__(self, service, method, handler, **kwargs):
+        self.service = service
+        self.method = method
+        self.handler = handler
+        self.kwargs = kwargs
+
+    def execute(self, **kwargs):
+        self.service._count(self.method)
+        time.sleep(self.service.latency)
+        return self.handler(**self.kwargs)
+
+
+def _next_request(previous_request, previous_response):
+    # list_next of a discovery collection
+    token = previous_response.get('nextPageToken')
+    if not token:
+        return None
+    kwargs = dict(previous_request.kwargs, pageToken=token)
+    return FakeRequest(previous_request.service, previous_request.method,
+                       previous_request.handler, **kwargs)
+
+
+def _page(items, page_token, page_size):
+    # (items of the page, nextPageToken or None)
+    start = int(page_token or 0)
+    token = None
+    if start + page_size < len(items):
+        token = str(start + page_size)
+    return items[start:start + page_size], token
+
+
+class FakeBatch(object):
+    # BatchHttpRequest, one call for all the requests added to it
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, **kwargs):
+        self.service._count('batch')
+        time.sleep(self.service.latency)
+        for request_id, request in self.requests:
+            self.service._count(request.method)
+            self.callback(request_id, request.handler(**request.kwargs), None)
+
+
+class _FakeDiscoveryService(object):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, method):
+        with self._lock:
+            self.calls[method] += 1
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+
+class _FakeCollection(object):
+    # Methods of a discovery collection, name -> handler
+    def __init__(self, service, prefix, **handlers):
+        self._service = service
+        self._prefix = prefix
+        self._handlers = handlers
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name.endswith('_next'):
+            return _next_request
+        handler = self._handlers[name]
+        return lambda **kwargs: FakeRequest(
+            self._service, self._prefix + '.' + name, handler, **kwargs)
+
+
+class FakeComputeService(_FakeDiscoveryService):
+    # compute v1 zones().list and instances().list / aggregatedList over
+    # zones x instances_per_zone instances, page_size items per page
+    def __init__(self, zones=500, instances_per_zone=4, page_size=500,
+                 latency=0.0):
+        _FakeDiscoveryService.__init__(self, latency)
+        self.zone_names = ['zone-{:03d}-a'.format(z) for z in range(zones)]
+        self.zone_instances = {zone: [{"name": '{}-instance-{}'.format(zone, i),
+                                  "creationTimestamp": '2020-01-01T00:00:00.000-07:00',
+                                  "status": 'RUNNING'}
+                                 for i in range(instances_per_zone)]
+                          for zone in self.zone_names}
+        self.page_size = page_size
+
+    def zones(self):
+        return _FakeCollection(self, 'compute.zones', list=self._zones)
+
+    def instances(self):
+        return _FakeCollection(self, 'compute.instances',
+                               list=self._instances,
+                               aggregatedList=self._aggregated)
+
+    def _zones(self, project, pageToken=None, **kwargs):
+        zones, token = _page([{"name": z} for z in self.zone_names],
+                             pageToken, self.page_size)
+        response = {"items": zones}
+        if token:
+            response["nextPageToken"] = token
+        return response
+
+    def _instances(self, project, zone, pageToken=None, **kwargs):
+        instances, token = _page(self.zone_instances[zone], pageToken,
+                                 self.page_size)
+        response = {"items": instances}
+        if token:
+            response["nextPageToken"] = token
+        return response
+
+    def _aggregated(self, project, pageToken=None, **kwargs):
+        scoped = [(zone, instance) for zone in self.zone_names
+                  for instance in self.zone_instances[zone]]
+        scoped, token = _page(scoped, pageToken, self.page_size)
+        items = {}
+        for zone, instance in scoped:
+            items.setdefault('zones/' + zone, {"instances": []})[
+                "instances"].append(instance)
+        response = {"items": items}
+        if token:
+            response["nextPageToken"] = token
+        return response
+
+
+class FakeIamService(_FakeDiscoveryService):
+    # iam v1 projects().serviceAccounts().list and keys().list for
+    # accounts service accounts with one system managed key and
+    # user_keys user managed keys each
+    def __init__(self, accounts=1000, user_keys=2, project='fake-project',
+                 latency=0.0):
+        _FakeDiscoveryService.__init__(self, latency)
+        self.accounts = [{"name": 'projects/{0}/serviceAccounts/sa-{1}@{0}'
+                                  '.iam.gserviceaccount.com'.format(project, i),
+                          "email": 'sa-{}@{}.iam.gserviceaccount.com'.format(
+                              i, project)}
+                         for i in range(accounts)]
+        self.user_keys = user_keys
+
+    def projects(self):
+        return self
+
+    def serviceAccounts(self):
+        collection = _FakeCollection(self, 'iam.serviceAccounts',
+                                     list=self._accounts)
+        collection.keys = lambda: _FakeCollection(
+            self, 'iam.serviceAccounts.keys', list=self._keys)
+        return collection
+
+    def _accounts(self, name, pageSize=100, pageToken=None, **kwargs):
+        accounts, token = _page(self.accounts, pageToken, min(pageSize, 100))
+        response = {"accounts": accounts}
+        if token:
+            response["nextPageToken"] = token
+        return response
+
+    def _keys(self, name, **kwargs):
+        keys = [{"name": name + '/keys/system', "keyType": 'SYSTEM_MANAGED',
+                 "validAfterTime": '2026-01-01T00:00:00Z',
+                 "validBeforeTime": '2026-01-15T00:00:00Z'}]
+        for k in range(self.user_keys):
+            keys.append({"name": '{}/keys/user-{}'.format(name, k),
+                         "keyType": 'USER_MANAGED',
+                         "validAfterTime": '20{:02d}-01-01T00:00:00Z'.format(
+                             20 + k),
+                         "validBeforeTime": '9999-12-31T23:59:59Z'})
+        return {"keys": keys}
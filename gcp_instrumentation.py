@@ -0,0 +1,306 @@
+"""Counts and times the API calls made by the gcp-utils scripts.
+
+Nothing is recorded until a recorder is installed, until then call()
+only calls through. With a recorder installed every call made with
+call(endpoint, fn) (call_with_retry(..., endpoint=...) uses it) is
+recorded under its endpoint name: number of calls, errors, retries,
+response bytes and a latency histogram.
+
+Response bytes are counted at the transport layer by response_hook, which
+gcp_clients installs on its shared requests session, so every HTTP
+response the google-cloud clients (BigQuery) receive during a call is
+counted, paged list calls included. Discovery clients (Compute, IAM) use
+httplib2, their bytes are the JSON length of the response. gRPC clients
+(Pub/Sub) have no transport bytes, pubsub_async_puller records the
+message data size under pubsub.ack instead.
+
+The recorder is pluggable, any object with
+    record(endpoint, seconds, nbytes=0, error=None)
+    record_retry(endpoint, error=None)
+can be installed, e.g. to forward to a metrics system. The default
+Recorder keeps everything in memory and exports it as JSON:
+
+    import gcp_instrumentation
+    recorder = gcp_instrumentation.install()
+    ...
+    recorder.export('metrics.json')
+
+The scripts install it with --metrics_file (add_arguments and
+install_from_args), the file is written at exit.
+"""
+import atexit
+import json
+import math
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+              30000, 60000)
+
+_recorder = None
+# Bytes received by the calling thread during the current call()
+_thread_state = threading.local()
+
+
+def nearest_rank(count, pct):
+    # 1 based rank of the pct-th percentile among count sorted values
+    return max(1, math.ceil(pct / 100.0 * count))
+
+
+def percentile(values, pct):
+    # Nearest rank percentile of a sorted list, None when it is empty
+    if not values:
+        return None
+    return values[nearest_rank(len(values), pct) - 1]
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        # one count per bucket of BUCKETS_MS plus one for longer calls
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, seconds, nbytes=0, error=None):
+        self.calls += 1
+        self.bytes += nbytes
+        if error is not None:
+            self.errors += 1
+        if seconds is None:
+            return
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        ms = seconds * 1000
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.histogram[i] += 1
+                return
+        self.histogram[-1] += 1
+
+    def percentile_ms(self, pct):
+        # Upper bound of the bucket holding the pct-th percentile call,
+        # capped at the slowest call
+        timed = sum(self.histogram)
+        if not timed:
+            return None
+        rank = nearest_rank(timed, pct)
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if seen >= rank and count:
+                if i < len(BUCKETS_MS):
+                    return min(BUCKETS_MS[i],
+                               round(self.max_seconds * 1000, 1))
+                return round(self.max_seconds * 1000, 1)
+        return round(self.max_seconds * 1000, 1)
+
+    def to_dict(self):
+        timed = sum(self.histogram)
+        labels = ['<={}ms'.format(bound) for bound in BUCKETS_MS]
+        labels.append('>{}ms'.format(BUCKETS_MS[-1]))
+        return {"calls": self.calls,
+                "errors": self.errors,
+                "retries": self.retries,
+                "bytes": self.bytes,
+                "total_seconds": round(self.seconds, 3),
+                "mean_ms": round(self.seconds * 1000 / timed, 1) if timed else None,
+                "p50_ms": self.percentile_ms(50),
+                "p95_ms": self.percentile_ms(95),
+                "p99_ms": self.percentile_ms(99),
+                "max_ms": round(self.max_seconds * 1000, 1),
+                "histogram": {label: count for label, count
+                              in zip(labels, self.histogram) if count}}
+
+
+class Recorder(object):
+    # In memory statistics per endpoint, safe to use from many threads
+    def __init__(self):
+        self.endpoints = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def _stats(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats()
+        return stats
+
+    def record(self, endpoint, seconds, nbytes=0, error=None):
+        with self._lock:
+            self._stats(endpoint).add(seconds, nbytes, error)
+
+    def record_retry(self, endpoint, error=None):
+        with self._lock:
+            self._stats(endpoint).retries += 1
+
+    def calls(self):
+        # endpoint -> number of calls
+        with self._lock:
+            return {name: stats.calls for name, stats in self.endpoints.items()}
+
+    def to_dict(self):
+        with self._lock:
+            return {"started": self.started,
+                    "seconds": round(time.time() - self.started, 3),
+                    "endpoints": {name: self.endpoints[name].to_dict()
+                                  for name in sorted(self.endpoints)}}
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def report(self):
+        lines = []
+        for name, stats in self.to_dict()["endpoints"].items():
+            lines.append("{:<36} calls {:>7} errors {:>4} retries {:>4} "
+                         "p50 {}ms p95 {}ms max {}ms".format(
+                             name, stats["calls"], stats["errors"],
+                             stats["retries"], stats["p50_ms"],
+                             stats["p95_ms"], stats["max_ms"]))
+        return "\n".join(lines)
+
+
+def install(recorder=None):
+    # Starts recording with recorder (a new Recorder by default)
+    global _recorder
+    if recorder is None:
+        recorder = Recorder()
+    _recorder = recorder
+    return recorder
+
+
+def uninstall():
+    global _recorder
+    _recorder = None
+
+
+def active():
+    # The installed recorder or None
+    return _recorder
+
+
+def export_at_exit(path, recorder=None):
+    # Installs a recorder and writes its JSON to path when the process
+    # exits
+    recorder = install(recorder)
+    atexit.register(recorder.export, path)
+    return recorder
+
+
+def add_arguments(parser):
+    # --metrics_file of the scripts, see install_from_args
+    parser.add_argument(
+        '--metrics_file',
+        required=False,
+        default=None,
+        help=('Write the API calls per endpoint (count, errors, retries, '
+              'bytes, latency histogram) to this JSON file at exit')
+        )
+
+
+def install_from_args(args):
+    # Recorder exported to args.metrics_file at exit, None without it
+    if args.metrics_file:
+        return export_at_exit(args.metrics_file)
+    return None
+
+
+def response_hook(response, *args, **kwargs):
+    # requests response hook, adds the body size to the call() running in
+    # this thread. Streamed bodies are counted by their Content-Length
+    # only, so they are not read here.
+    if getattr(_thread_state, 'nbytes', None) is None:
+        return
+    if kwargs.get('stream'):
+        nbytes = int(response.headers.get('Content-Length') or 0)
+    else:
+        nbytes = len(response.content)
+    _thread_state.nbytes += nbytes
+
+
+def _start_counting():
+    # Starts counting transport bytes for a call, returns the count of an
+    # enclosing call to hand to _stop_counting
+    outer = getattr(_thread_state, 'nbytes', None)
+    _thread_state.nbytes = 0
+    return outer
+
+
+def _stop_counting(outer):
+    # Bytes counted since _start_counting, also added to the enclosing call
+    nbytes = _thread_state.nbytes
+    _thread_state.nbytes = None if outer is None else outer + nbytes
+    return nbytes
+
+
+def response_bytes(response):
+    # Approximate size of an API response without transport bytes: JSON
+    # length of discovery responses (dicts), length of bytes / str, 0 for
+    # client objects
+    if isinstance(response, (bytes, str)):
+        return len(response)
+    if isinstance(response, dict):
+        return len(json.dumps(response, default=str))
+    return 0
+
+
+def record(endpoint, seconds, nbytes=0, error=None):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.record(endpoint, seconds, nbytes, error)
+
+
+def record_retry(endpoint, error=None):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.record_retry(endpoint, error)
+
+
+def call(endpoint, fn, *args, **kwargs):
+    # fn(*args, **kwargs), recorded under endpoint when a recorder is
+    # installed
+    recorder = _recorder
+    if recorder is None:
+        return fn(*args, **kwargs)
+    outer = _start_counting()
+    start = time.perf_counter()
+    try:
+        response = fn(*args, **kwargs)
+    except Exception as exc:
+        seconds = time.perf_counter() - start
+        recorder.record(endpoint, seconds, _stop_counting(outer), error=exc)
+        raise
+    seconds = time.perf_counter() - start
+    nbytes = _stop_counting(outer)
+    recorder.record(endpoint, seconds, nbytes or response_bytes(response))
+    return response
+
+
+def iter_pages(endpoint, iterator):
+    # Items of a paged list call (google.api_core HTTPIterator), each page
+    # fetch recorded as one call. Iterators without pages are passed on.
+    pages = getattr(iterator, 'pages', None)
+    if pages is None or _recorder is None:
+        yield from iterator
+        return
+    pages = iter(pages)
+    while True:
+        outer = _start_counting()
+        start = time.perf_counter()
+        try:
+            page = next(pages)
+        except StopIteration:
+            _stop_counting(outer)
+            return
+        except Exception as exc:
+            seconds = time.perf_counter() - start
+            record(endpoint, seconds, _stop_counting(outer), error=exc)
+            raise
+        seconds = time.perf_counter() - start
+        record(endpoint, seconds, _stop_counting(outer))
+        yield from page
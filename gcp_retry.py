@@ -0,0 +1,92 @@
+"""Retry and rate limiting helpers shared by the gcp-utils scripts.
+
+Google APIs answer bursts of requests with 429 / 403 rateLimitExceeded or
+with transient 5xx errors. call_with_retry retries such calls with
+exponential backoff and jitter, any other error is raised straight away.
+Works with both google.api_core exceptions (google-cloud-* clients) and
+googleapiclient HttpError (discovery based clients).
+RateLimiter keeps a pool of threads under a calls per second budget.
+"""
+import random
+import threading
+import time
+import gcp_instrumentation
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+# 403 is only worth retrying when it is a quota / rate limit error
+RETRYABLE_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded',
+                     'quotaExceeded', 'backendError')
+
+
+def status_code(exc):
+    # google.api_core exceptions carry the HTTP status in .code,
+    # googleapiclient HttpError carries it in .resp.status
+    code = getattr(exc, 'code', None)
+    if isinstance(code, int):
+        return code
+    status = getattr(getattr(exc, 'resp', None), 'status', None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(exc):
+    code = status_code(exc)
+    if code in RETRYABLE_STATUS:
+        return True
+    if code == 403:
+        return any(reason in str(exc) for reason in RETRYABLE_REASONS)
+    return isinstance(exc, (ConnectionError, TimeoutError))
+
+
+def call_with_retry(fn, *args, retries=5, backoff=1.0, max_backoff=32.0,
+                    on_retry=None, endpoint=None, **kwargs):
+    # Calls fn(*args, **kwargs), retrying up to retries times on
+    # retryable errors. Sleeps backoff, 2*backoff, 4*backoff ... seconds
+    # (capped at max_backoff) with jitter between attempts.
+    # on_retry(exc), if given, is called before each retry.
+    # endpoint, if given, names the call for gcp_instrumentation: each
+    # attempt is timed and each retry counted under that name.
+    attempt = 0
+    while True:
+        try:
+            if endpoint is None:
+                return fn(*args, **kwargs)
+            return gcp_instrumentation.call(endpoint, fn, *args, **kwargs)
+        except Exception as exc:
+            if attempt >= retries or not is_retryable(exc):
+                raise
+            if on_retry is not None:
+                on_retry(exc)
+            if endpoint is not None:
+                gcp_instrumentation.record_retry(endpoint, exc)
+            delay = min(max_backoff, backoff * (2 ** attempt))
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            attempt += 1
+
+
+class RateLimiter(object):
+    # Client side token bucket shared by threads, acquire() blocks until
+    # the call is allowed. rate is calls per second, None means no limit.
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate or 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens
+                                  + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,214 @@
+"""Batched, durable file sink for messages pulled from Pub/Sub.
+
+Messages are handed to add() from any thread and written by one long
+lived writer thread. The writer collects them into a batch and writes the
+batch in one call when it holds max_batch messages or max_bytes bytes, or
+when the oldest message has waited flush_seconds. After the write the
+file is flushed and fsync'ed, and only then are the ack callbacks of the
+batch called, so a message is acked once it is on disk. If the write
+fails the nack callbacks are called instead and the messages are
+redelivered.
+
+The file is rotated when it grows over rotate_bytes: msg.log is renamed
+to msg.log.YYYYMMDDTHHMMSS and a new msg.log is started. With
+compression='gzip' the file is msg.log.gz, every batch is written as a
+sync flushed part of the gzip stream.
+
+Run with --benchmark to compare with opening the file per message.
+"""
+import argparse
+import gzip
+import os
+import queue
+import threading
+import time
+
+
+class MessageSink(object):
+    # Up to queue_size messages wait for the writer, add() blocks beyond
+    # that so a slow disk slows down the subscriber instead of using
+    # up memory.
+    def __init__(self, path='msg.log', max_batch=1000, max_bytes=1000000,
+                 flush_seconds=1.0, rotate_bytes=None, compression=None,
+                 fsync=True, queue_size=10000):
+        if compression not in (None, 'gzip'):
+            raise ValueError('Unknown compression: {}'.format(compression))
+        if compression == 'gzip' and not path.endswith('.gz'):
+            path = path + '.gz'
+        self.path = path
+        self.max_batch = max_batch
+        self.max_bytes = max_bytes
+        self.flush_seconds = flush_seconds
+        self.rotate_bytes = rotate_bytes
+        self.compression = compression
+        self.fsync = fsync
+        self.messages_written = 0
+        self.messages_failed = 0
+        self.batches = 0
+        self.rotations = 0
+        self._file = None
+        self._raw = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, data, ack=None, nack=None):
+        # data is bytes (Pub/Sub message.data) or str, one line per message
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._queue.put((data, ack, nack))
+
+    def close(self):
+        # Writes what is left, then stops the writer thread
+        self._queue.put(None)
+        self._thread.join()
+        self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self):
+        self._raw = open(self.path, 'ab')
+        if self.compression == 'gzip':
+            self._file = gzip.GzipFile(fileobj=self._raw, mode='ab')
+        else:
+            self._file = self._raw
+
+    def _close_file(self):
+        if self._file is not None:
+            if self._file is not self._raw:
+                self._file.close()
+            self._raw.close()
+            self._file = self._raw = None
+
+    def _rotate(self):
+        self._close_file()
+        root, ext = self.path, ''
+        if self.compression == 'gzip':
+            root, ext = self.path[:-3], '.gz'
+        rotated = '{}.{}{}'.format(root, time.strftime('%Y%m%dT%H%M%S'), ext)
+        n = 1
+        while os.path.exists(rotated):
+            rotated = '{}.{}-{}{}'.format(root, time.strftime('%Y%m%dT%H%M%S'),
+                                          n, ext)
+            n += 1
+        os.replace(self.path, rotated)
+        self.rotations += 1
+
+    def _write(self, batch):
+        try:
+            if self._file is None:
+                self._open()
+            self._file.write(b''.join(data + b'\n' for data, _, _ in batch))
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._raw.fileno())
+        except Exception as exc:
+            print('Write to {} failed: {}'.format(self.path, exc))
+            self._close_file()
+            self.messages_failed += len(batch)
+            for _, _, nack in batch:
+                if nack is not None:
+                    nack()
+            return
+        self.messages_written += len(batch)
+        self.batches += 1
+        for _, ack, _ in batch:
+            if ack is not None:
+                ack()
+        if self.rotate_bytes and self._raw.tell() >= self.rotate_bytes:
+            self._rotate()
+
+    def _run(self):
+        batch = []
+        batch_bytes = 0
+        deadline = None
+        while True:
+            timeout = None
+            if batch:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                # oldest message waited flush_seconds
+                self._write(batch)
+                batch, batch_bytes = [], 0
+                continue
+            if item is None:
+                if batch:
+                    self._write(batch)
+                return
+            if not batch:
+                deadline = time.monotonic() + self.flush_seconds
+            batch.append(item)
+            batch_bytes += len(item[0]) + 1
+            if len(batch) >= self.max_batch or batch_bytes >= self.max_bytes:
+                self._write(batch)
+                batch, batch_bytes = [], 0
+
+
+def benchmark(count=100000, size=200, path='msg_benchmark.log', **kwargs):
+    # Messages per second of MessageSink against opening, writing and
+    # closing the file per message
+    data = b'x' * size
+    acked = []
+    start = time.time()
+    with MessageSink(path, **kwargs) as sink:
+        for _ in range(count):
+            sink.add(data, ack=lambda: acked.append(1))
+    sink_seconds = time.time() - start
+    os.remove(sink.path)
+
+    per_message = min(count, 10000)
+    start = time.time()
+    for _ in range(per_message):
+        msglog = open(path, 'ab')
+        msglog.write(data + b'\n')
+        msglog.close()
+    open_seconds = time.time() - start
+    os.remove(path)
+
+    print('MessageSink: {} messages in {:.2f}s, {:.0f} msg/s, {} batches, '
+          '{} acked'.format(count, sink_seconds, count / sink_seconds,
+                            sink.batches, len(acked)))
+    print('Open per message: {} messages in {:.2f}s, {:.0f} msg/s'.format(
+        per_message, open_seconds, per_message / open_seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--benchmark',
+        required=False,
+        action='store_true',
+        help=('Run the write benchmark')
+        )
+    parser.add_argument(
+        '--count',
+        required=False,
+        default=100000,
+        help=('Messages written by the benchmark, 100000 is default')
+        )
+    parser.add_argument(
+        '--compression',
+        required=False,
+        default=None,
+        choices=['gzip'],
+        help=('Compress the file')
+        )
+    parser.add_argument(
+        '--no_fsync',
+        required=False,
+        action='store_true',
+        help=('Flush batches without fsync')
+        )
+    args = parser.parse_args()
+    if not args.benchmark:
+        parser.error('Use --benchmark, the sink is used by pubsub_async_puller')
+    benchmark(int(args.count), compression=args.compression,
+              fsync=not args.no_fsync)
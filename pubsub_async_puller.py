@@ -1,22 +1,335 @@
-from google.cloud import pubsub_v1
+"""
+This code pulls messages from a Pub/Sub subscription and appends them, one
+line per message, to a log file (msg.log by default).
 
+Messages are written in batches by the MessageSink writer thread (see
+message_sink) and acked only once their batch is flushed and fsync'ed,
+so a crash never loses an acked message. The file is rotated at
+--rotate_mb and can be gzip compressed.
 
-subscriber = pubsub_v1.SubscriberClient()
-subscriber_path = subscriber.subscription_path('xw-winter-bloom-7', 'sub1')
+Throughput is tuned with:
+--streams       parallel streaming pulls on the subscription
+--max_messages  flow control, outstanding (not yet acked) messages and
+--max_mb        bytes per stream, so a backlog never fills memory
+--scheduler     thread: ThreadScheduler on a pool of --threads threads per
+                stream, default: the library default scheduler
+A batch is written once --max_batch messages are waiting, so keep it at
+or below streams x max_messages, else every batch waits --flush_seconds.
 
+--benchmark publishes --count messages and reports messages/sec and the
+latency from delivery to ack. It uses the Pub/Sub emulator when
+PUBSUB_EMULATOR_HOST is set, else an in-process fake (gcp_fakes) that
+needs no google-cloud-pubsub. It gives up after --timeout seconds and
+reports the messages not acked.
 
-def write_msg(msg):
-    msglog = open('msg.log', 'a+')
-    msglog.write(msg + "\n")
-    msglog.close()
+With --metrics_file acked messages (count, bytes, delivery to ack latency
+histogram) are written as JSON under pubsub.ack, see gcp_instrumentation.
 
+This code uses application default credentials.
+"""
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import gcp_instrumentation
+from message_sink import MessageSink
 
-def callback(message):
-    write_msg(message.data)
-#    print(message.data)
-    message.ack()
 
+def make_callback(sink, on_ack=None):
+    # on_ack(seconds) gets the time from delivery to ack of every message,
+    # also recorded as pubsub.ack when gcp_instrumentation is installed
+    def callback(message):
+        ack = message.ack
+        if on_ack is not None or gcp_instrumentation.active() is not None:
+            received = time.monotonic()
 
-future = subscriber.subscribe(subscriber_path, callback)
+            def ack():
+                message.ack()
+                seconds = time.monotonic() - received
+                gcp_instrumentation.record('pubsub.ack', seconds,
+                                           len(message.data))
+                if on_ack is not None:
+                    on_ack(seconds)
+        # acked by the sink once the message is on disk
+        sink.add(message.data, ack=ack, nack=message.nack)
+    return callback
 
-future.result()
+
+# offline=True builds the settings of gcp_fakes.FakeSubscriberClient, so
+# the benchmark runs without google-cloud-pubsub installed
+def make_flow_control(max_messages=1000, max_bytes=100 * 1024 * 1024,
+                      offline=False):
+    if offline:
+        import gcp_fakes
+
+        return gcp_fakes.FakeFlowControl(max_messages, max_bytes)
+    from google.cloud import pubsub_v1
+
+    return pubsub_v1.types.FlowControl(max_messages=max_messages,
+                                       max_bytes=max_bytes)
+
+
+def make_scheduler(scheduler='thread', threads=10, offline=False):
+    if scheduler == 'default':
+        return None
+    executor = ThreadPoolExecutor(max_workers=threads,
+                                  thread_name_prefix='pubsub-callback')
+    if offline:
+        import gcp_fakes
+
+        return gcp_fakes.FakeThreadScheduler(executor)
+    from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+
+    return ThreadScheduler(executor=executor)
+
+
+def subscribe(subscriber, subscriber_path, callback, streams=1,
+              max_messages=1000, max_bytes=100 * 1024 * 1024,
+              scheduler='thread', threads=10, offline=False):
+    # One streaming pull per stream, each with its own flow control
+    # limits and scheduler. Returns the streaming pull futures.
+    flow_control = make_flow_control(max_messages, max_bytes, offline)
+    futures = []
+    for _ in range(streams):
+        futures.append(subscriber.subscribe(
+            subscriber_path, callback, flow_control=flow_control,
+            scheduler=make_scheduler(scheduler, threads, offline)))
+    return futures
+
+
+def wait(futures):
+    # Blocks until a stream fails or Ctrl-C, then stops every stream
+    try:
+        while not any(future.done() for future in futures):
+            time.sleep(1)
+        for future in futures:
+            future.result()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def main(project, subscription, path='msg.log', max_batch=1000,
+         flush_seconds=1.0, rotate_mb=None, compression=None, streams=1,
+         max_messages=1000, max_mb=100, scheduler='thread', threads=10):
+    from google.cloud import pubsub_v1
+
+    subscriber = pubsub_v1.SubscriberClient()
+    subscriber_path = subscriber.subscription_path(project, subscription)
+    rotate_bytes = None
+    if rotate_mb:
+        rotate_bytes = int(rotate_mb * 1024 * 1024)
+    sink = MessageSink(path, max_batch=max_batch, flush_seconds=flush_seconds,
+                       rotate_bytes=rotate_bytes, compression=compression)
+    futures = subscribe(subscriber, subscriber_path, make_callback(sink),
+                        streams, max_messages, int(max_mb * 1024 * 1024),
+                        scheduler, threads)
+    try:
+        wait(futures)
+    finally:
+        sink.close()
+        print("Messages written {}".format(sink.messages_written))
+
+
+def _emulator_subscription(project, count, size):
+    # Topic and subscription on the emulator with count messages waiting
+    from google.cloud import pubsub_v1
+
+    publisher = pubsub_v1.PublisherClient()
+    subscriber = pubsub_v1.SubscriberClient()
+    name = 'benchmark-{}'.format(int(time.time()))
+    topic_path = publisher.topic_path(project, name)
+    subscriber_path = subscriber.subscription_path(project, name)
+    publisher.create_topic(name=topic_path)
+    subscriber.create_subscription(name=subscriber_path, topic=topic_path)
+    data = b'x' * size
+    published = [publisher.publish(topic_path, data) for _ in range(count)]
+    for future in published:
+        future.result()
+    return subscriber, subscriber_path
+
+
+def benchmark(project='benchmark', count=100000, size=200, streams=1,
+              max_messages=1000, max_mb=100, scheduler='thread', threads=10,
+              max_batch=1000, flush_seconds=0.1, path='msg_benchmark.log',
+              timeout=300):
+    # Stops after timeout seconds even if some messages were never acked.
+    # Returns the number of messages acked.
+    offline = not os.environ.get('PUBSUB_EMULATOR_HOST')
+    if not offline:
+        print("Using the emulator at {}".format(
+            os.environ['PUBSUB_EMULATOR_HOST']))
+        subscriber, subscriber_path = _emulator_subscription(project, count,
+                                                             size)
+    else:
+        import gcp_fakes
+
+        subscriber = gcp_fakes.FakeSubscriberClient()
+        subscriber_path = subscriber.subscription_path(project, 'benchmark')
+        for _ in range(count):
+            subscriber.publish(subscriber_path, b'x' * size)
+
+    latencies = []
+    lock = threading.Lock()
+    finished = threading.Event()
+
+    def on_ack(seconds):
+        with lock:
+            latencies.append(seconds)
+            if len(latencies) >= count:
+                finished.set()
+
+    sink = MessageSink(path, max_batch=max_batch, flush_seconds=flush_seconds)
+    start = time.time()
+    futures = subscribe(subscriber, subscriber_path,
+                        make_callback(sink, on_ack), streams, max_messages,
+                        int(max_mb * 1024 * 1024), scheduler, threads,
+                        offline)
+    finished.wait(timeout)
+    seconds = time.time() - start
+    for future in futures:
+        future.cancel()
+    sink.close()
+    os.remove(sink.path)
+
+    with lock:
+        acked_latencies = sorted(latencies)
+    acked = len(acked_latencies)
+    if acked < count:
+        print("Timed out after {}s, {} of {} messages not acked".format(
+            timeout, count - acked, count))
+    if not acked:
+        return acked
+
+    print("{} messages in {:.2f}s, {:.0f} msg/s, streams {}, scheduler {}, "
+          "threads {}, max_messages {}".format(
+              acked, seconds, acked / seconds, streams, scheduler, threads,
+              max_messages))
+    print("Ack latency p50 {:.1f}ms p90 {:.1f}ms p99 {:.1f}ms "
+          "max {:.1f}ms".format(
+              gcp_instrumentation.percentile(acked_latencies, 50) * 1000,
+              gcp_instrumentation.percentile(acked_latencies, 90) * 1000,
+              gcp_instrumentation.percentile(acked_latencies, 99) * 1000,
+              acked_latencies[-1] * 1000))
+    return acked
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--projectid',
+        required=False,
+        default='xw-winter-bloom-7',
+        help=('Project of the subscription, xw-winter-bloom-7 is default')
+        )
+    parser.add_argument(
+        '--subscription',
+        required=False,
+        default='sub1',
+        help=('Subscription to pull from, sub1 is default')
+        )
+    parser.add_argument(
+        '--path',
+        required=False,
+        default='msg.log',
+        help=('File messages are appended to, msg.log is default')
+        )
+    parser.add_argument(
+        '--max_batch',
+        required=False,
+        default=1000,
+        help=('Messages written per batch, 1000 is default')
+        )
+    parser.add_argument(
+        '--flush_seconds',
+        required=False,
+        default=1.0,
+        help=('Longest a message waits before its batch is written, '
+              '1 is default')
+        )
+    parser.add_argument(
+        '--rotate_mb',
+        required=False,
+        default=None,
+        help=('Rotate the file when it is over this size in MB')
+        )
+    parser.add_argument(
+        '--compression',
+        required=False,
+        default=None,
+        choices=['gzip'],
+        help=('Compress the file')
+        )
+    parser.add_argument(
+        '--streams',
+        required=False,
+        default=1,
+        help=('Parallel streaming pulls, 1 is default')
+        )
+    parser.add_argument(
+        '--max_messages',
+        required=False,
+        default=1000,
+        help=('Outstanding messages per stream, 1000 is default')
+        )
+    parser.add_argument(
+        '--max_mb',
+        required=False,
+        default=100,
+        help=('Outstanding MB per stream, 100 is default')
+        )
+    parser.add_argument(
+        '--scheduler',
+        required=False,
+        default='thread',
+        choices=['thread', 'default'],
+        help=('Callback scheduler, thread is default')
+        )
+    parser.add_argument(
+        '--threads',
+        required=False,
+        default=10,
+        help=('Callback threads per stream with --scheduler thread, '
+              '10 is default')
+        )
+    parser.add_argument(
+        '--benchmark',
+        required=False,
+        action='store_true',
+        help=('Run the benchmark instead of pulling')
+        )
+    parser.add_argument(
+        '--count',
+        required=False,
+        default=100000,
+        help=('Messages published by the benchmark, 100000 is default')
+        )
+    parser.add_argument(
+        '--timeout',
+        required=False,
+        default=300,
+        help=('Seconds the benchmark waits for every ack, 300 is default')
+        )
+    gcp_instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    gcp_instrumentation.install_from_args(args)
+    if args.benchmark:
+        benchmark(args.projectid, int(args.count),
+                  streams=int(args.streams),
+                  max_messages=int(args.max_messages),
+                  max_mb=float(args.max_mb), scheduler=args.scheduler,
+                  threads=int(args.threads), max_batch=int(args.max_batch),
+                  timeout=float(args.timeout))
+    else:
+        rotate_mb = None
+        if args.rotate_mb:
+            rotate_mb = float(args.rotate_mb)
+        main(args.projectid, args.subscription, args.path,
+             int(args.max_batch), float(args.flush_seconds), rotate_mb,
+             args.compression, int(args.streams), int(args.max_messages),
+             float(args.max_mb), args.scheduler, int(args.threads))
@@ -0,0 +1,143 @@
+"""Streaming record writers used by the gcp-utils scripts.
+
+RecordWriter writes dict records to date named files as they are produced
+instead of holding them until the end, so memory stays flat however many
+records a run produces. The file rotates when the date changes.
+
+Formats:
+ndjson   one JSON document per line, PREFIXYYYY-MM-DD.json
+gzip     gzip compressed ndjson, PREFIXYYYY-MM-DD.json.gz
+parquet  columnar, PREFIXYYYY-MM-DD.parquet, rows are buffered and
+         written one row group at a time, needs pyarrow. Pass the
+         pyarrow schema of the records, else it is inferred from the
+         first row group and a column that is empty or None all through
+         that group can not take values later.
+
+iter_records reads any of them back one record at a time.
+
+read_json / write_json keep small state files (watermarks, indexes)
+between runs, write_json replaces the file atomically.
+"""
+import datetime
+import gzip
+import json
+import os
+import time
+
+EXTENSIONS = {'ndjson': '.json', 'gzip': '.json.gz', 'parquet': '.parquet'}
+
+
+class RecordWriter(object):
+    # mode 'a' appends to today's file. Parquet files can not be appended
+    # to, in that mode a new PREFIXYYYY-MM-DD-HHMMSS.parquet part is made.
+    def __init__(self, prefix, output_format='ndjson', mode='w',
+                 row_group_size=10000, schema=None):
+        if output_format not in EXTENSIONS:
+            raise ValueError('Unknown output format {}'.format(output_format))
+        self.prefix = prefix
+        self.output_format = output_format
+        self.mode = mode
+        self.row_group_size = row_group_size
+        self.day = None
+        self.path = None
+        self.paths = []
+        self.count = 0
+        self._file = None
+        self._rows = []
+        self.schema = schema
+        self._schema = schema
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _filename(self, day):
+        name = self.prefix + str(day) + EXTENSIONS[self.output_format]
+        if (self.output_format == 'parquet' and self.mode == 'a'
+                and os.path.exists(name)):
+            name = "{}{}-{}.parquet".format(self.prefix, day,
+                                            time.strftime("%H%M%S"))
+        return name
+
+    def _open(self, day):
+        self.day = day
+        self.path = self._filename(day)
+        self.paths.append(self.path)
+        if self.output_format == 'ndjson':
+            self._file = open(self.path, self.mode)
+        elif self.output_format == 'gzip':
+            # appending adds a gzip member, readers see one stream
+            self._file = gzip.open(self.path, self.mode + 't')
+
+    def _flush_rows(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        if not self._rows:
+            return
+        table = pyarrow.Table.from_pylist(self._rows, schema=self._schema)
+        if self._file is None:
+            self._schema = table.schema
+            self._file = pyarrow.parquet.ParquetWriter(self.path,
+                                                       self._schema)
+        self._file.write_table(table)
+        self._rows = []
+
+    def write(self, record):
+        today = datetime.date.today()
+        if today != self.day:
+            self.close()
+            self._open(today)
+        if self.output_format == 'parquet':
+            self._rows.append(record)
+            if len(self._rows) >= self.row_group_size:
+                self._flush_rows()
+        else:
+            self._file.write(json.dumps(record, default=str) + "\n")
+        self.count += 1
+
+    def close(self):
+        if self.output_format == 'parquet':
+            self._flush_rows()
+            self._schema = self.schema
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_json(path, default=None):
+    # JSON document of path, default when the file does not exist
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(path, data):
+    # Write to a temp file and rename so a crash never leaves half a file
+    with open(path + ".tmp", 'w') as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+def iter_records(path):
+    # Records of a file written by RecordWriter, format from the extension
+    if not os.path.exists(path):
+        return
+    if path.endswith('.parquet'):
+        import pyarrow.parquet
+
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            for record in batch.to_pylist():
+                yield record
+        return
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rt')
+    else:
+        f = open(path)
+    with f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
@@ -1,7 +1,185 @@
+"""
+This code lists the keys of every service account in a project and flags
+keys that are too old or expired, for compliance checks on key rotation.
+
+Keys of many accounts are listed per round trip with a googleapiclient
+BatchHttpRequest (--batch_size accounts per batch), or with --mode pool on
+a thread pool (--workers). Results are keyed by service account name:
+email, keys (keyType, validAfterTime, validBeforeTime, age_days, expired,
+older_than_max_age), user_managed_keys and compliant, which is false when
+a user managed key is older than --max_key_age_days.
+Output file is PROJECTID_service_accnt_key_compliance_check.json
+
+This code uses application default credentials.
+"""
 import json
 import argparse
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timezone
+import gcp_clients
+import gcp_instrumentation
+from gcp_retry import call_with_retry, is_retryable
+
+
+def get_service():
+    # IAM service of the calling thread, see gcp_clients
+    return gcp_clients.get_service('iam', 'v1')
+
+
+def list_service_accounts(service, project):
+    # Required. The resource name of the project associated with the service
+    # accounts, such as `projects/my-project-123`.
+    project_name = 'projects/' + project
+
+    service_account_list = []
+    request = service.projects().serviceAccounts().list(name=project_name,
+                                                        pageSize=100)
+    while True:
+        response = call_with_retry(request.execute,
+                                   endpoint='iam.serviceAccounts.list')
+
+        for service_account in response.get('accounts', []):
+            service_account_list.append(service_account)
+
+        request = service.projects().serviceAccounts().list_next(
+                                        previous_request=request,
+                                        previous_response=response)
+        if request is None:
+            break
+    return service_account_list
+
+
+def list_keys_batched(service, account_names, batch_size=100, retries=5):
+    # account name -> keys().list response, batch_size accounts per
+    # round trip. Calls failing with rate limit errors go in the next
+    # batch, after a backoff, up to retries times. When a whole batch
+    # fails (e.g. a transport error) only the accounts without a response
+    # yet are sent again, callbacks already run are not repeated.
+    responses = {}
+    pending = list(account_names)
+    attempt = 0
+    while pending:
+        failed = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+            elif attempt < retries and is_retryable(exception):
+                gcp_instrumentation.record_retry(
+                    'iam.serviceAccounts.keys.list', exception)
+                failed.append(request_id)
+            else:
+                responses[request_id] = {"error": str(exception)}
+
+        for start in range(0, len(pending), batch_size):
+            names = pending[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=callback)
+            for name in names:
+                batch.add(service.projects().serviceAccounts().keys().list(
+                    name=name), request_id=name)
+            try:
+                gcp_instrumentation.call('iam.batch(keys.list)',
+                                         batch.execute)
+            except Exception as exc:
+                unanswered = [name for name in names
+                              if name not in responses and name not in failed]
+                if attempt < retries and is_retryable(exc):
+                    gcp_instrumentation.record_retry('iam.batch(keys.list)',
+                                                     exc)
+                    failed.extend(unanswered)
+                else:
+                    for name in unanswered:
+                        responses[name] = {"error": str(exc)}
+        pending = failed
+        if pending:
+            time.sleep(min(32, 2 ** attempt))
+            attempt += 1
+    return responses
+
+
+def list_keys_pool(account_names, workers=16, retries=5,
+                   service_factory=get_service):
+    # account name -> keys().list response, one call per account on a
+    # thread pool, each thread with its own service
+    def list_keys(name):
+        request = service_factory().projects().serviceAccounts().keys().list(
+            name=name)
+        try:
+            return name, call_with_retry(
+                request.execute, retries=retries,
+                endpoint='iam.serviceAccounts.keys.list')
+        except Exception as exc:
+            return name, {"error": str(exc)}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(pool.map(list_keys, account_names))
+
+
+def _parse_time(value):
+    # IAM times look like 2020-01-01T00:00:00Z
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(
+        tzinfo=timezone.utc)
+
+
+def key_record(key, max_key_age_days=90, now=None):
+    if now is None:
+        now = datetime.now(timezone.utc)
+    valid_after = _parse_time(key['validAfterTime'])
+    valid_before = _parse_time(key['validBeforeTime'])
+    age_days = (now - valid_after).days
+    return {"name": key['name'],
+            "keyType": key.get('keyType'),
+            "disabled": key.get('disabled', False),
+            "validAfterTime": key['validAfterTime'],
+            "validBeforeTime": key['validBeforeTime'],
+            "age_days": age_days,
+            "expired": valid_before <= now,
+            "older_than_max_age": age_days > max_key_age_days}
+
+
+def scan(project, max_key_age_days=90, mode='batch', batch_size=100,
+         workers=16, service=None, service_factory=get_service):
+    # service account name -> email, keys with age / expiry flags,
+    # number of user managed keys and whether the account is compliant
+    if service is None:
+        service = service_factory()
+    accounts = list_service_accounts(service, project)
+    names = [account['name'] for account in accounts]
+    if mode == 'pool':
+        responses = list_keys_pool(names, workers,
+                                   service_factory=service_factory)
+    else:
+        responses = list_keys_batched(service, names, batch_size)
+    now = datetime.now(timezone.utc)
+    service_account_keys = {}
+    for account in accounts:
+        response = responses.get(account['name'], {})
+        keys = [key_record(key, max_key_age_days, now)
+                for key in response.get('keys', [])]
+        user_managed = [key for key in keys
+                        if key['keyType'] == 'USER_MANAGED']
+        entry = {"email": account.get('email'),
+                 "keys": keys,
+                 "user_managed_keys": len(user_managed),
+                 "compliant": not any(key['older_than_max_age']
+                                      for key in user_managed)}
+        if 'error' in response:
+            entry["error"] = response['error']
+            entry["compliant"] = None
+        service_account_keys[account['name']] = entry
+    return service_account_keys
+
+
+def run(project, max_key_age_days=90, mode='batch', batch_size=100,
+        workers=16):
+    service_account_keys = scan(project, max_key_age_days, mode, batch_size,
+                                workers)
+    f = open(project + '_service_accnt_key_compliance_check.json', 'w')
+    f.write(json.dumps(service_account_keys))
+    f.close()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -12,37 +190,33 @@ if __name__ == '__main__':
         required=True,
         help=('Provide Project Id')
         )
+    parser.add_argument(
+        '--max_key_age_days',
+        required=False,
+        default=90,
+        help=('User managed keys older than this are flagged, 90 is default')
+        )
+    parser.add_argument(
+        '--mode',
+        required=False,
+        default='batch',
+        choices=['batch', 'pool'],
+        help=('batch: BatchHttpRequest (default), pool: thread pool')
+        )
+    parser.add_argument(
+        '--batch_size',
+        required=False,
+        default=100,
+        help=('Accounts per batch request, 100 is default')
+        )
+    parser.add_argument(
+        '--workers',
+        required=False,
+        default=16,
+        help=('Threads in pool mode, 16 is default')
+        )
+    gcp_instrumentation.add_arguments(parser)
     args = parser.parse_args()
-
-# Required. The resource name of the project associated with the service
-# accounts, such as `projects/my-project-123`.
-project_name = 'projects/' + args.projectid
-
-credentials = GoogleCredentials.get_application_default()
-service = discovery.build('iam', 'v1', credentials=credentials)
-
-service_account_list = []
-request = service.projects().serviceAccounts().list(name=project_name)
-while True:
-    response = request.execute()
-
-    for service_account in response.get('accounts', []):
-        service_account_list.append(service_account['name'])
-
-    request = service.projects().serviceAccounts().list_next(
-                                    previous_request=request,
-                                    previous_response=response)
-    if request is None:
-        break
-# print(service_account_list)
-service_account_keys = {}
-cnt = 1
-for sa in service_account_list:
-    request = service.projects().serviceAccounts().keys().list(name=sa)
-    response = request.execute()
-    service_account_keys[cnt] = response
-    cnt = cnt + 1
-
-f = open(args.projectid + '_service_accnt_key_compliance_check.json', 'w')
-f.write(json.dumps(service_account_keys))
-f.close()
+    gcp_instrumentation.install_from_args(args)
+    run(args.projectid, int(args.max_key_age_days), args.mode,
+        int(args.batch_size), int(args.workers))
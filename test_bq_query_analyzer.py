@@ -0,0 +1,92 @@
+import pytest
+
+from bq_query_analyzer import analyze, referenced_tables, rule_names, tokenize
+
+PARTITIONS = {'partition_columns': {'ds.events': 'event_date'}}
+
+
+@pytest.mark.parametrize('query, rules', [
+    # select_star
+    ("SELECT * FROM ds.t WHERE id = 1", ['select_star']),
+    ("SELECT t.* FROM ds.t AS t WHERE id = 1", ['select_star']),
+    ("SELECT a, * FROM ds.t WHERE id = 1", ['select_star']),
+    ("SELECT COUNT(*) FROM ds.t WHERE id = 1", []),
+    ("SELECT a FROM ds.t WHERE b = 'SELECT *'", []),
+    ("-- SELECT * FROM ds.t\nSELECT a FROM ds.t WHERE id = 1", []),
+    # cross_join
+    ("SELECT a FROM ds.t CROSS JOIN ds.u WHERE id = 1", ['cross_join']),
+    ("SELECT a FROM ds.t, ds.u WHERE id = 1", ['cross_join']),
+    ("SELECT a FROM ds.t CROSS JOIN UNNEST(t.xs) AS x WHERE id = 1", []),
+    ("SELECT a FROM ds.t, UNNEST(t.xs) AS x WHERE id = 1", []),
+    ("SELECT a FROM ds.t AS t, t.xs AS x WHERE id = 1", []),
+    ("SELECT a FROM ds.t JOIN ds.u ON t.id = u.id WHERE id = 1", []),
+    # order_by_without_limit
+    ("SELECT a FROM ds.t WHERE id = 1 ORDER BY a",
+     ['order_by_without_limit']),
+    ("SELECT a FROM ds.t WHERE id = 1 ORDER BY a LIMIT 10", []),
+    ("SELECT a, ROW_NUMBER() OVER (ORDER BY b) FROM ds.t WHERE id = 1",
+     []),
+    # no_filter
+    ("SELECT a FROM ds.t", ['no_filter']),
+    ("SELECT a FROM (SELECT a FROM ds.t WHERE id = 1)", ['no_filter']),
+    ("SELECT 1", []),
+    # FROM of a function call is not a table or a FROM clause
+    ("SELECT EXTRACT(YEAR FROM ts) AS y FROM ds.t WHERE id = 1", []),
+    ("SELECT SUBSTRING(s FROM 2), TRIM(BOTH 'x' FROM s) FROM ds.t "
+     "WHERE id = 1", []),
+    ("SELECT EXTRACT(YEAR FROM ts) AS y, a FROM ds.t, ds.u WHERE id = 1",
+     ['cross_join']),
+])
+def test_rules(query, rules):
+    assert rule_names(analyze(query)) == rules
+
+
+@pytest.mark.parametrize('query, rules', [
+    ("SELECT a FROM ds.events WHERE id = 1", ['missing_partition_filter']),
+    ("SELECT a FROM `proj.ds.events` WHERE id = 1",
+     ['missing_partition_filter']),
+    ("SELECT a FROM ds.events WHERE event_date = '2020-01-01'", []),
+    ("SELECT a FROM ds.events WHERE _PARTITIONDATE = '2020-01-01'", []),
+    ("SELECT a FROM ds.other WHERE id = 1", []),
+    ("SELECT EXTRACT(YEAR FROM event_date) AS y FROM ds.other WHERE id = 1",
+     []),
+    ("SELECT EXTRACT(YEAR FROM ts) AS y FROM ds.events "
+     "WHERE event_date = '2020-01-01'", []),
+])
+def test_missing_partition_filter(query, rules):
+    assert rule_names(analyze(query, context=PARTITIONS)) == rules
+
+
+def test_function_from_is_not_a_partitioned_table():
+    # events is a column here, not the partitioned table events
+    context = {'partition_columns': {'events': 'event_date'}}
+    query = "SELECT EXTRACT(YEAR FROM events) AS y FROM ds.t WHERE id = 1"
+    assert rule_names(analyze(query, context=context)) == []
+
+
+def test_missing_partition_filter_needs_partition_columns():
+    assert rule_names(analyze("SELECT a FROM ds.events WHERE id = 1")) == []
+
+
+@pytest.mark.parametrize('query, tables', [
+    ("SELECT a FROM `proj.ds.t` JOIN ds.u ON t.id = u.id",
+     ['proj.ds.t', 'ds.u']),
+    ("SELECT a FROM my-proj.ds.t", ['my-proj.ds.t']),
+    ("SELECT a FROM ds.t, UNNEST(xs)", ['ds.t']),
+    ("SELECT a FROM (SELECT a FROM ds.t)", ['ds.t']),
+    ("SELECT EXTRACT(DAY FROM ts), ARRAY(SELECT x FROM ds.u) FROM ds.t",
+     ['ds.u', 'ds.t']),
+    ("WITH x AS (SELECT CAST(EXTRACT(YEAR FROM ts) AS STRING) FROM ds.t) "
+     "SELECT * FROM x", ['ds.t', 'x']),
+])
+def test_referenced_tables(query, tables):
+    assert referenced_tables(tokenize(query)) == tables
+
+
+def test_findings_have_rule_offset_and_message():
+    query = "SELECT * FROM ds.t"
+    findings = analyze(query)
+    assert [f['rule'] for f in findings] == ['select_star', 'no_filter']
+    assert query[findings[0]['offset']] == '*'
+    assert query[findings[1]['offset']:].startswith('FROM')
+    assert all(f['message'] for f in findings)
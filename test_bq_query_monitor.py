@@ -0,0 +1,95 @@
+import datetime
+import glob
+
+import pytest
+
+import bq_query_monitor
+from gcp_fakes import FakeBigQueryClient, make_jobs
+from record_writers import iter_records
+
+
+@pytest.fixture
+def jobs():
+    # 100 jobs in the last 24 hours, 90 with a complete listing
+    return make_jobs(100)
+
+
+def _since(hours=25):
+    return (datetime.datetime.now(datetime.timezone.utc)
+            - datetime.timedelta(hours=hours))
+
+
+def test_iter_query_jobs_fetches_only_incomplete_listings(jobs):
+    client = FakeBigQueryClient(jobs)
+    timings = {}
+    found = list(bq_query_monitor.iter_query_jobs(client, _since(),
+                                                  workers=4,
+                                                  timings=timings))
+    incomplete = sum(1 for job in jobs if not job.listing_complete)
+    assert incomplete == 10
+    assert client.calls['get_job'] == incomplete
+    assert timings['fetch_calls'] == incomplete
+    assert sorted(job.job_id for job in found) == sorted(
+        job.job_id for job in jobs)
+    assert not any(bq_query_monitor.needs_fetch(job) for job in found)
+
+
+def test_iter_query_jobs_complete_listing_makes_no_get_job_calls():
+    client = FakeBigQueryClient(make_jobs(50, listing_complete=1.0))
+    found = list(bq_query_monitor.iter_query_jobs(client, _since()))
+    assert len(found) == 50
+    assert client.calls['get_job'] == 0
+
+
+def test_iter_query_jobs_skip_job_is_checked_before_fetch(jobs):
+    client = FakeBigQueryClient(jobs)
+    found = list(bq_query_monitor.iter_query_jobs(
+        client, _since(), skip_job=lambda job: True))
+    assert found == []
+    assert client.calls['get_job'] == 0
+
+
+def _written_job_ids():
+    ids = []
+    for path in glob.glob('bq_monitor_2*.json'):
+        ids.extend(record['job_id'] for record in iter_records(path))
+    return ids
+
+
+def test_incremental_second_run_fetches_nothing_already_seen(
+        jobs, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    client = FakeBigQueryClient(jobs)
+    first = bq_query_monitor.get_incremental_data(
+        'fake-project', 'watermark.json', hours=25, workers=4,
+        client=client)
+    assert first['jobs'] == len(jobs)
+    assert client.calls['get_job'] == 10
+
+    client.calls.clear()
+    second = bq_query_monitor.get_incremental_data(
+        'fake-project', 'watermark.json', workers=4, client=client)
+    assert second['jobs'] == 0
+    assert second['fetch_calls'] == 0
+    assert client.calls['get_job'] == 0
+    assert sorted(_written_job_ids()) == sorted(job.job_id for job in jobs)
+
+
+def test_incremental_run_picks_up_only_new_jobs(jobs, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    client = FakeBigQueryClient(jobs)
+    bq_query_monitor.get_incremental_data(
+        'fake-project', 'watermark.json', hours=25, client=client)
+
+    # Two new jobs, one of them with an incomplete listing
+    now = datetime.datetime.now(datetime.timezone.utc)
+    new_jobs = make_jobs(2, end=now, hours=0.01, listing_complete=0.5)
+    for i, job in enumerate(new_jobs):
+        job.job_id = 'new_job_{}'.format(i)
+        client.add_job(job)
+    client.calls.clear()
+    timings = bq_query_monitor.get_incremental_data(
+        'fake-project', 'watermark.json', client=client)
+    assert timings['jobs'] == 2
+    assert client.calls['get_job'] == 1
+    assert len(_written_job_ids()) == len(jobs) + 2
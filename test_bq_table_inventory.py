@@ -0,0 +1,161 @@
+import datetime
+
+import pytest
+
+import bq_table_inventory
+from gcp_fakes import FakeBigQueryClient, FakeTable, make_tables
+from record_writers import read_json, write_json
+
+PROJECT = 'fake-project'
+
+BACKENDS = {
+    'api': lambda: bq_table_inventory.api_backend,
+    'information_schema': lambda: bq_table_inventory.information_schema_backend,
+    'region': lambda: bq_table_inventory.region_backend(['us']),
+}
+
+
+def crawl(client, snapshot_index=None, backend=bq_table_inventory.api_backend):
+    rows = []
+    for _, table_metadata in bq_table_inventory.crawl_inventory(
+            client, PROJECT, workers=4, dataset_workers=2,
+            snapshot_index=snapshot_index, backend=backend):
+        rows.extend(table_metadata)
+    return rows
+
+
+def changes(rows):
+    return sorted((row['changeType'], row['datasetId'], row['tableID'])
+                  for row in rows)
+
+
+def key(dataset_id, table_id):
+    return PROJECT + '.' + dataset_id + '.' + table_id
+
+
+@pytest.fixture
+def client():
+    # dataset_000 .. dataset_002, three tables each
+    return FakeBigQueryClient(tables=make_tables(3, 3))
+
+
+def test_full_crawl_has_every_table_without_change_type(client):
+    rows = crawl(client)
+    assert len(rows) == 9
+    assert all('changeType' not in row for row in rows)
+    assert client.calls['get_table'] == 9
+
+
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+def test_first_incremental_crawl_creates_every_table(client, backend):
+    index = {}
+    rows = crawl(client, index, BACKENDS[backend]())
+    assert {row['changeType'] for row in rows} == {'CREATED'}
+    assert len(rows) == 9
+    assert sorted(index) == sorted(key('dataset_{:03d}'.format(d),
+                                       'table_{:05d}'.format(t))
+                                   for d in range(3) for t in range(3))
+    entry = index[key('dataset_000', 'table_00002')]
+    assert entry['numBytes'] == 2000
+    assert entry['lastModifiedMs'] == 1577836800000
+    assert entry['row']['tableID'] == 'table_00002'
+    if backend != 'api':
+        # Metadata comes from the queries, not the per table API
+        assert client.calls['get_table'] == 0
+        assert client.calls['query'] > 0
+
+
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+def test_second_crawl_emits_only_changes(client, backend):
+    index = {}
+    crawl(client, index, BACKENDS[backend]())
+
+    changed = client.tables['dataset_000']['table_00001']
+    changed.modified += datetime.timedelta(hours=1)
+    changed.num_bytes = 5000
+    client.add_table(FakeTable(PROJECT, 'dataset_000', 'table_new',
+                               changed.modified, num_bytes=10))
+    del client.tables['dataset_002']['table_00000']
+    del client.tables['dataset_001']
+
+    rows = crawl(client, index, BACKENDS[backend]())
+    assert changes(rows) == [
+        ('CHANGED', 'dataset_000', 'table_00001'),
+        ('CREATED', 'dataset_000', 'table_new'),
+        ('DELETED', 'dataset_001', 'table_00000'),
+        ('DELETED', 'dataset_001', 'table_00001'),
+        ('DELETED', 'dataset_001', 'table_00002'),
+        ('DELETED', 'dataset_002', 'table_00000'),
+    ]
+    # Deleted rows are the last known row of the table
+    deleted = [row for row in rows if row['changeType'] == 'DELETED']
+    assert all(row['numRows'] is not None for row in deleted)
+
+    assert sorted(index) == sorted([
+        key('dataset_000', 'table_00000'),
+        key('dataset_000', 'table_00001'),
+        key('dataset_000', 'table_00002'),
+        key('dataset_000', 'table_new'),
+        key('dataset_002', 'table_00001'),
+        key('dataset_002', 'table_00002'),
+    ])
+    entry = index[key('dataset_000', 'table_00001')]
+    assert entry['numBytes'] == 5000
+    assert entry['lastModifiedMs'] == 1577836800000 + 3600 * 1000
+    assert entry['row']['changeType'] == 'CHANGED'
+
+    # Nothing changed since, nothing to emit
+    assert crawl(client, index, BACKENDS[backend]()) == []
+
+
+def test_unchanged_tables_skip_get_table(client):
+    index = {}
+    crawl(client, index)
+    client.tables['dataset_001']['table_00002'].num_bytes = 1
+    client.calls.clear()
+    rows = crawl(client, index)
+    assert changes(rows) == [('CHANGED', 'dataset_001', 'table_00002')]
+    assert client.calls['get_table'] == 1
+
+
+def test_saved_index_round_trips(client, tmp_path):
+    path = str(tmp_path / 'index.json')
+    index = {}
+    crawl(client, index)
+    write_json(path, index)
+
+    saved = read_json(path, {})
+    assert saved == index
+    del client.tables['dataset_000']['table_00000']
+    rows = crawl(client, saved)
+    assert changes(rows) == [('DELETED', 'dataset_000', 'table_00000')]
+    write_json(path, saved)
+    assert key('dataset_000', 'table_00000') not in read_json(path, {})
+
+
+@pytest.mark.parametrize('backend', ['information_schema', 'region'])
+def test_failed_query_falls_back_to_api(client, backend, monkeypatch):
+    def query(sql, **kwargs):
+        raise RuntimeError('Access Denied: INFORMATION_SCHEMA')
+
+    monkeypatch.setattr(client, 'query', query)
+    rows = crawl(client, backend=BACKENDS[backend]())
+    assert len(rows) == 9
+    assert client.calls['list_tables'] == 3
+    assert client.calls['get_table'] == 9
+
+
+def test_failed_query_falls_back_to_api_with_index(client, monkeypatch):
+    index = {}
+    crawl(client, index, BACKENDS['information_schema']())
+
+    def query(sql, **kwargs):
+        raise RuntimeError('Access Denied: INFORMATION_SCHEMA')
+
+    monkeypatch.setattr(client, 'query', query)
+    client.add_table(FakeTable(PROJECT, 'dataset_002', 'table_new',
+                               datetime.datetime.now(datetime.timezone.utc)))
+    rows = crawl(client, index, BACKENDS['region']())
+    # Without __TABLES__ every table is read again, only the new one differs
+    assert changes(rows) == [('CREATED', 'dataset_002', 'table_new')]
+    assert key('dataset_002', 'table_new') in index
@@ -0,0 +1,220 @@
+"""Offline reverse geocoding of latitude / longitude to ZIP codes.
+
+ZIP code centroids are loaded from a local file into a spatial index and
+whole arrays of points are resolved to the nearest centroid in one call,
+without a network request per point. The default column names are the
+ones of the US Census ZCTA Gazetteer file (GEOID, INTPTLAT, INTPTLONG,
+tab separated), e.g. 2020_Gaz_zcta_national.txt from
+https://www.census.gov/geographies/reference-files/time-series/geo/gazetteer-files.html
+
+Points and centroids are turned into unit vectors so the straight line
+distance orders them like the great circle distance. The index is a
+scipy cKDTree, or a chunked numpy brute force search (a few hundred
+times slower) when scipy is not installed. With cache_precision set,
+points are rounded to that many decimals (4 is about 11 m) and each
+distinct rounded point is resolved once and kept, so repeated pickup
+locations cost one lookup. The cache keeps the cache_size most recently
+used points (200000 by default, a few tens of MB), so memory stays
+bounded however many points go through.
+
+Run with --benchmark to time lookups against random centroids.
+"""
+import argparse
+import collections
+import csv
+import time
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def _unit_vectors(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon),
+                            np.sin(lat)))
+
+
+def load_centroids(path, zip_field='GEOID', lat_field='INTPTLAT',
+                   lon_field='INTPTLONG', delimiter=None):
+    # zipcodes, latitudes, longitudes of a delimited file, the delimiter
+    # is tab for .txt files and comma otherwise unless given
+    if delimiter is None:
+        delimiter = '\t' if path.endswith('.txt') else ','
+    zipcodes, lats, lons = [], [], []
+    with open(path, newline='') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = [name.strip() for name in next(reader)]
+        zip_index = header.index(zip_field)
+        lat_index = header.index(lat_field)
+        lon_index = header.index(lon_field)
+        for row in reader:
+            if not row:
+                continue
+            zipcodes.append(row[zip_index].strip())
+            lats.append(float(row[lat_index]))
+            lons.append(float(row[lon_index]))
+    return (np.array(zipcodes, dtype=object), np.array(lats),
+            np.array(lons))
+
+
+class ZipGeocoder(object):
+    # Nearest centroid of every point. Points further than max_km from
+    # any centroid get None.
+    def __init__(self, zipcodes, lats, lons, max_km=None, cache_precision=4,
+                 chunk_size=2048, cache_size=200000):
+        self.zipcodes = np.asarray(zipcodes, dtype=object)
+        self.max_km = max_km
+        self.cache_precision = cache_precision
+        self.chunk_size = chunk_size
+        self.cache_size = cache_size
+        # rounded point key -> ZIP code, least recently used first
+        self.cache = collections.OrderedDict()
+        self._vectors = _unit_vectors(lats, lons)
+        try:
+            from scipy.spatial import cKDTree
+
+            self._tree = cKDTree(self._vectors)
+        except ImportError:
+            self._tree = None
+
+    @classmethod
+    def from_file(cls, path, zip_field='GEOID', lat_field='INTPTLAT',
+                  lon_field='INTPTLONG', delimiter=None, **kwargs):
+        return cls(*load_centroids(path, zip_field, lat_field, lon_field,
+                                   delimiter), **kwargs)
+
+    def _nearest(self, points):
+        # Index of the nearest centroid and straight line distance on the
+        # unit sphere of every point
+        if self._tree is not None:
+            distance, index = self._tree.query(points)
+            return index, distance
+        index = np.empty(len(points), dtype=np.int64)
+        similarity = np.empty(len(points))
+        for start in range(0, len(points), self.chunk_size):
+            dots = points[start:start + self.chunk_size] @ self._vectors.T
+            index[start:start + len(dots)] = dots.argmax(axis=1)
+            similarity[start:start + len(dots)] = dots.max(axis=1)
+        distance = np.sqrt(np.maximum(0.0, 2.0 - 2.0 * similarity))
+        return index, distance
+
+    def _resolve(self, lat, lon):
+        zipcodes = np.full(len(lat), None, dtype=object)
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        if not valid.any():
+            return zipcodes
+        index, distance = self._nearest(_unit_vectors(lat[valid],
+                                                      lon[valid]))
+        found = self.zipcodes[index]
+        if self.max_km is not None:
+            # chord length on the unit sphere to great circle km
+            km = 2.0 * np.arcsin(np.minimum(1.0, distance / 2.0)) * \
+                EARTH_RADIUS_KM
+            found[km > self.max_km] = None
+        zipcodes[valid] = found
+        return zipcodes
+
+    def lookup(self, lat, lon):
+        # ZIP code (str or None) of every point, as a numpy object array
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        if self.cache_precision is None:
+            return self._resolve(lat, lon)
+        # One int64 key per rounded point, -1 for missing coordinates
+        scale = 10 ** self.cache_precision
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        lat_steps = np.round(np.where(valid, lat, 0) * scale).astype(np.int64)
+        lon_steps = np.round(np.where(valid, lon, 0) * scale).astype(np.int64)
+        keys = (lat_steps + 90 * scale) * (361 * scale) + \
+            (lon_steps + 180 * scale)
+        keys[~valid] = -1
+        keys, inverse = np.unique(keys, return_inverse=True)
+        unique_zipcodes = np.empty(len(keys), dtype=object)
+        missing = []
+        cache = self.cache
+        for i, key in enumerate(keys.tolist()):
+            if key in cache:
+                unique_zipcodes[i] = cache[key]
+                cache.move_to_end(key)
+            elif key != -1:
+                missing.append(i)
+        if missing:
+            missing_keys = keys[missing]
+            resolved = self._resolve(
+                (missing_keys // (361 * scale) - 90 * scale) / scale,
+                (missing_keys % (361 * scale) - 180 * scale) / scale)
+            unique_zipcodes[missing] = resolved
+            cache.update(zip(missing_keys.tolist(), resolved))
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return unique_zipcodes[inverse.reshape(-1)]
+
+
+def benchmark(points=1000000, centroids=33000, locations=100000, seed=0):
+    # Random centroids over the US, points drawn from locations distinct
+    # pickup spots around New York like taxi data
+    rng = np.random.default_rng(seed)
+    geocoder = ZipGeocoder(np.array(['{:05d}'.format(i)
+                                     for i in range(centroids)]),
+                           rng.uniform(25, 49, centroids),
+                           rng.uniform(-124, -67, centroids))
+    spot_lat = rng.uniform(40.5, 40.9, locations).round(4)
+    spot_lon = rng.uniform(-74.1, -73.7, locations).round(4)
+    pick = rng.integers(0, locations, points)
+    lat, lon = spot_lat[pick], spot_lon[pick]
+    index = 'cKDTree' if geocoder._tree is not None else 'numpy brute force'
+    for label in ('cold cache', 'warm cache'):
+        start = time.time()
+        geocoder.lookup(lat, lon)
+        seconds = time.time() - start
+        print('{} {}: {} points in {:.2f}s, {:.0f} points/s'.format(
+            index, label, points, seconds, points / seconds))
+    geocoder.cache_precision = None
+    start = time.time()
+    geocoder.lookup(lat, lon)
+    seconds = time.time() - start
+    print('{} no cache: {} points in {:.2f}s, {:.0f} points/s'.format(
+        index, points, seconds, points / seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--benchmark',
+        required=False,
+        action='store_true',
+        help=('Time lookups against random centroids')
+        )
+    parser.add_argument(
+        '--points',
+        required=False,
+        default=1000000,
+        help=('Points looked up by the benchmark, 1000000 is default')
+        )
+    parser.add_argument(
+        '--centroids',
+        required=False,
+        help=('Centroid file, to look up --lat and --lon')
+        )
+    parser.add_argument(
+        '--lat',
+        required=False,
+        help=('Latitude to look up')
+        )
+    parser.add_argument(
+        '--lon',
+        required=False,
+        help=('Longitude to look up')
+        )
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(int(args.points))
+    elif args.centroids and args.lat and args.lon:
+        geocoder = ZipGeocoder.from_file(args.centroids)
+        print(geocoder.lookup([float(args.lat)], [float(args.lon)])[0])
+    else:
+        parser.error('Use --benchmark or --centroids with --lat and --lon')